@@ -0,0 +1,49 @@
+"""The bot reads config.toml, index.json, lang.json and assets/ from the
+working directory when imported, so the tests run from a scratch directory
+that links to the repository's files."""
+
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+TEST_CONFIG = """\
+bot_token = "123456:TEST"
+database_uri = "sqlite:///test.db"
+owner_id = [1]
+chat_id = -1
+pool_size = 1
+cooldown = 60
+"""
+
+workdir_key = pytest.StashKey[Path]()
+
+
+def make_workdir(path: Path, extra_config: str = "") -> Path:
+    path.mkdir(parents=True, exist_ok=True)
+    for name in ("assets", "index.json", "lang.json"):
+        (path / name).symlink_to(ROOT / name)
+    (path / "config.toml").write_text(TEST_CONFIG + extra_config)
+    return path
+
+
+def pytest_sessionstart(session: pytest.Session):
+    # Before collection, which imports the bot.
+    session.config.stash[workdir_key] = workdir = Path(
+        tempfile.mkdtemp(prefix="vannish-tests-")
+    )
+    os.chdir(make_workdir(workdir))
+
+
+def pytest_sessionfinish(session: pytest.Session):
+    os.chdir(ROOT)
+    shutil.rmtree(session.config.stash[workdir_key], ignore_errors=True)
+
+
+@pytest.fixture
+def prescaled_workdir(tmp_path: Path) -> Path:
+    return make_workdir(tmp_path / "prescaled", "prescale_assets = true\n")
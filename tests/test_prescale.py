@@ -0,0 +1,54 @@
+import json
+import math
+import os
+import subprocess
+import sys
+from dataclasses import astuple
+from pathlib import Path
+
+from PIL import Image, ImageChops, ImageStat
+from PIL.Image import Image as ImageType
+
+from vannish_cards.render import RenderConfig, render
+
+ROOT = Path(__file__).resolve().parent.parent
+
+MIN_PSNR = 37.0
+CASES = [
+    RenderConfig("#203ed0", "squares", "common", "Dungeonerrr", 1),
+    RenderConfig("#ddf9ff", "slime", "hyper", "Creator", None),
+    RenderConfig("#7f3fbf", "fee", "legendary", "Hero", 1999),
+]
+
+# PRESCALE_ASSETS is read at import, so the prescaled renders are made in a
+# separate process with prescale_assets = true in its config.toml.
+RENDER_SCRIPT = """
+import json, sys
+from vannish_cards.render import RenderConfig, render
+for i, case in enumerate(json.loads(sys.argv[1])):
+    render(RenderConfig(*case)).save(f"prescaled_{i}.png")
+"""
+
+
+def psnr(a: ImageType, b: ImageType) -> float:
+    rms = ImageStat.Stat(ImageChops.difference(a, b)).rms
+    mse = sum(value**2 for value in rms) / len(rms)
+    return math.inf if mse == 0 else 10 * math.log10(255**2 / mse)
+
+
+def test_prescaled_render_is_visually_equivalent(prescaled_workdir: Path):
+    cases = [astuple(case) for case in CASES]
+    subprocess.run(
+        [sys.executable, "-c", RENDER_SCRIPT, json.dumps(cases)],
+        cwd=prescaled_workdir,
+        env={**os.environ, "PYTHONPATH": str(ROOT)},
+        check=True,
+    )
+
+    for i, case in enumerate(CASES):
+        expected = render(case)
+        with Image.open(prescaled_workdir / f"prescaled_{i}.png") as prescaled:
+            assert prescaled.size == expected.size
+            value = psnr(prescaled.convert("RGBA"), expected)
+        # Identical output would mean the prescaled path was not taken.
+        assert MIN_PSNR <= value < math.inf, f"{case.background_type}: {value:.1f} dB"
@@ -0,0 +1,53 @@
+from pathlib import Path
+
+import pytest
+from PIL import Image, ImageColor
+from PIL.Image import Image as ImageType
+
+from vannish_cards.catalog import get_catalog
+from vannish_cards.data_types import RgbColor
+from vannish_cards.render import apply_color
+
+ASSETS = Path(__file__).resolve().parent.parent / "assets"
+# Every background, plus the outline which is recolored the same way.
+LAYERS = [
+    "outline.png",
+    *(f"background/{path.name}" for path in sorted(ASSETS.glob("background/*.png"))),
+]
+COLORS: list[RgbColor] = [
+    ImageColor.getrgb(color)[:3]  # type: ignore
+    for color in [*get_catalog().base_color_hex.values(), "#123456", "#000000"]
+]
+
+
+def apply_color_v1(img: ImageType, new_color: RgbColor) -> ImageType:
+    """The per-pixel recolor of v1.0.2, kept as the reference."""
+    modified_img = Image.new("RGBA", img.size, (0, 0, 0, 0))
+
+    pixels = img.load()
+    new_pixels = modified_img.load()
+    assert pixels is not None and new_pixels is not None
+
+    for x in range(img.width):
+        for y in range(img.height):
+            pixel = pixels[x, y]
+
+            if pixel[3] <= 0:  # type: ignore
+                continue
+
+            brightness = sum(pixel[:3]) / 3  # type: ignore
+
+            r = int((new_color[0] / 255) * (brightness / 255) * 255)
+            g = int((new_color[1] / 255) * (brightness / 255) * 255)
+            b = int((new_color[2] / 255) * (brightness / 255) * 255)
+
+            new_pixels[x, y] = (r, g, b, pixel[3])  # type: ignore
+
+    return modified_img
+
+
+@pytest.mark.parametrize("layer", LAYERS)
+def test_apply_color_matches_v1(layer: str):
+    img = Image.open(f"assets/{layer}").convert("RGBA")
+    color = COLORS[LAYERS.index(layer) % len(COLORS)]
+    assert apply_color(img, color).tobytes() == apply_color_v1(img, color).tobytes()
@@ -0,0 +1,25 @@
+import hashlib
+import json
+from pathlib import Path
+
+import pytest
+
+from vannish_cards.render import RenderConfig, render
+
+GOLDEN = Path(__file__).resolve().parent / "golden" / "render_v1_0_2.json"
+# SHA-256 of the raw RGBA pixels render() v1.0.2 produced for each config
+# with Pillow 11.3: every background, palette and custom colors, with and
+# without a number.
+GOLDEN_CASES: list[dict] = json.loads(GOLDEN.read_text())
+
+
+@pytest.mark.parametrize(
+    "case",
+    GOLDEN_CASES,
+    ids=[f"{case['background_type']}-{case['base_color']}" for case in GOLDEN_CASES],
+)
+def test_render_matches_v1_0_2(case: dict):
+    config = {key: value for key, value in case.items() if key != "sha256"}
+    img = render(RenderConfig(**config))
+    assert img.mode == "RGBA"
+    assert hashlib.sha256(img.tobytes()).hexdigest() == case["sha256"]
@@ -0,0 +1,208 @@
+"""Time each stage of the card render on a fixed set of cards.
+
+python -m vannish_cards.benchmark --output output/benchmarks/new.json
+python -m vannish_cards.benchmark --compare output/benchmarks/old.json
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+from collections.abc import Callable
+from datetime import datetime
+from time import perf_counter
+from typing import Any, TypeVar
+
+import PIL
+from PIL import ImageColor
+
+from .cache import PRESCALE_ASSETS, get_layer, load_layer
+from .catalog import get_catalog
+from .encoder import EncoderConfig, encode
+from .render import (
+    RenderConfig,
+    adjust_resolution,
+    draw_number,
+    get_frame,
+    make_frame,
+    paste_layer,
+    recolor_layer,
+    render,
+)
+
+T = TypeVar("T")
+
+# Off-palette color, so the uncached recolor path is covered too.
+CUSTOM_COLOR = "#7f3fbf"
+BENCHMARK_NUMBER = 1234
+
+
+def benchmark_cases() -> list[RenderConfig]:
+    """Every background in a palette and a custom color, rarities in turn."""
+    catalog = get_catalog()
+    backgrounds = sorted(catalog.backgrounds)
+    rarities = catalog.rarities
+    palette_color = catalog.get_base_color("blue")
+    nickname = sorted(catalog.players["common"])[0]
+
+    cases = []
+    for i, background in enumerate(backgrounds):
+        for j, color in enumerate((palette_color, CUSTOM_COLOR)):
+            cases.append(
+                RenderConfig(
+                    base_color=color,
+                    background_type=background,
+                    rarity=rarities[(i * 2 + j) % len(rarities)],
+                    nickname=nickname,
+                    number=BENCHMARK_NUMBER,
+                )
+            )
+    return cases
+
+
+def time_stage(
+    timings: dict[str, list[float]], stage: str, func: Callable[..., T], *args: Any
+) -> T:
+    start = perf_counter()
+    result = func(*args)
+    timings[stage].append(perf_counter() - start)
+    return result
+
+
+def benchmark_case(case: RenderConfig, timings: dict[str, list[float]]):
+    color = ImageColor.getrgb(case.base_color)  # type: ignore
+    color = (color[0], color[1], color[2])
+    paths = {
+        "outline": "assets/outline.png",
+        "background": f"assets/background/{case.background_type}.png",
+        "skin": f"assets/skin/{case.nickname}.png",
+        "nickname": f"assets/nickname/{case.nickname}.png",
+        "rarity": f"assets/rarity/{case.rarity}.png",
+    }
+    for name, path in paths.items():
+        time_stage(timings, f"load_{name}", load_layer, path)
+
+    layers = {name: get_layer(path) for name, path in paths.items()}
+    layers["base"] = get_layer("assets/base.png")
+    time_stage(timings, "apply_color_outline", recolor_layer, layers["outline"], color)
+    layers["background"] = time_stage(
+        timings, "apply_color_background", recolor_layer, layers["background"], color
+    )
+    time_stage(timings, "make_frame", make_frame, color)
+
+    img = time_stage(timings, "frame_copy", get_frame(color).copy)
+    for name in ("skin", "base", "background", "nickname", "rarity"):
+        time_stage(timings, f"paste_{name}", paste_layer, img, layers[name])
+    time_stage(timings, "draw_number", draw_number, img, case.number)
+    img = time_stage(timings, "adjust_resolution", adjust_resolution, img)
+    time_stage(timings, "encode_png", encode, img, EncoderConfig())
+
+    time_stage(timings, "render", render, case)
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    return {
+        "median_ms": statistics.median(samples) * 1000,
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "min_ms": min(samples) * 1000,
+        "max_ms": max(samples) * 1000,
+        "samples": len(samples),
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def run_benchmark(repeat: int) -> dict[str, Any]:
+    cases = benchmark_cases()
+    for case in cases:
+        # Untimed, so cached frames and layers are warm like in the bot.
+        render(case)
+
+    timings: dict[str, list[float]] = defaultdict(list)
+    for _ in range(repeat):
+        for case in cases:
+            benchmark_case(case, timings)
+
+    return {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "machine": platform.machine(),
+            "prescale_assets": PRESCALE_ASSETS,
+            "cases": len(cases),
+            "repeat": repeat,
+        },
+        "stages": {stage: summarize(samples) for stage, samples in timings.items()},
+    }
+
+
+def compare(old: dict[str, Any], new: dict[str, Any], threshold: float) -> bool:
+    """Print the median change of every stage; return whether any regressed."""
+    regressed = False
+    print(f"{'stage':<24}{'old ms':>10}{'new ms':>10}{'change':>10}")
+    for stage, stats in new["stages"].items():
+        if stage not in old["stages"]:
+            print(f"{stage:<24}{'-':>10}{stats['median_ms']:>10.2f}{'new':>10}")
+            continue
+        old_ms = old["stages"][stage]["median_ms"]
+        new_ms = stats["median_ms"]
+        change = (new_ms - old_ms) / old_ms if old_ms else 0.0
+        mark = ""
+        if change > threshold:
+            mark = "  regression"
+            regressed = True
+        print(f"{stage:<24}{old_ms:>10.2f}{new_ms:>10.2f}{change:>+10.1%}{mark}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m vannish_cards.benchmark",
+        description="Time each stage of the card render.",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="runs over all cases")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="median slowdown reported as a regression (default 0.1 = 10%%)",
+    )
+    args = parser.parse_args()
+
+    results = run_benchmark(args.repeat)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare is None:
+        for stage, stats in results["stages"].items():
+            print(f"{stage:<24}{stats['median_ms']:>10.2f} ms")
+        return
+
+    with open(args.compare) as f:
+        old = json.load(f)
+    if compare(old, results, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,32 @@
 import asyncio
-import os
 from datetime import datetime, timedelta
-from uuid import uuid4
+from time import perf_counter
+from weakref import WeakValueDictionary
 
 from aiogram.exceptions import (
     TelegramBadRequest,
     TelegramForbiddenError,
     TelegramNotFound,
 )
-from aiogram.types import Chat, FSInputFile, InlineKeyboardButton, InputMediaPhoto, User
+from aiogram.types import (
+    BufferedInputFile,
+    Chat,
+    FSInputFile,
+    InlineKeyboardButton,
+    InputFile,
+    InputMediaPhoto,
+    Message,
+    User,
+)
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.utils.markdown import hbold, hcode, hlink, text
 from loguru import logger
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from .bot import bot
-from .config import PAGE_LIMIT, config, get_base_color, hex_to_base_color, index, names
+from .cache import card_captions, known_users
+from .catalog import get_catalog
+from .config import PAGE_LIMIT, config
 from .data_types import (
     BackgroundEnum,
     BaseColorEnum,
@@ -29,37 +40,49 @@ from .database import (
     SavedUser,
     add_card,
     add_user,
-    get_card_by_number,
-    get_last_number_card,
+    allocate_card_numbers,
+    claim_last_card_time,
+    get_card_with_owner,
     get_user_by_id,
-    get_user_cards,
+    get_user_cards_page,
+    get_usernames,
+    save_card_file_id,
     update_last_card_time,
 )
+from .encoder import encoder_config
+from .metrics import user_lock_wait_seconds
 from .randomizer import random_render_config
-from .render import RenderConfig, render
+from .render import RenderConfig
+from .render_cache import card_render_config, render_cache, render_cached, render_key
+from .render_executor import RenderQueueFull, render_async, render_slot
 
-gen_card_lock = asyncio.Lock()
+# Serializes card draws of one user; draws of different users run concurrently.
+user_locks: WeakValueDictionary[int, asyncio.Lock] = WeakValueDictionary()
 
 
 async def send_cards_collection(
-    session: Session,
+    session: AsyncSession,
     user: SavedUser,
     message_id: int,
     edit_message: bool = False,
     page: int = 1,
+    after: int | None = None,
+    before: int | None = None,
 ):
-    cards: list[SavedCard] = get_user_cards(session, user.user_id)
-    if len(cards) == 0:
-        logger.error("No cards: empty list")
-        await bot.send_message(
-            config["chat_id"], "Нет карточек", reply_to_message_id=message_id
-        )
-        return
-
-    start_index = (page * PAGE_LIMIT) - PAGE_LIMIT
-    end_index = start_index + PAGE_LIMIT
+    # One extra row tells whether there is a page beyond this one.
+    cards: list[SavedCard] = await get_user_cards_page(
+        session, user.user_id, PAGE_LIMIT + 1, after=after, before=before
+    )
+    if before is not None:
+        has_previous = len(cards) > PAGE_LIMIT
+        has_next = True
+        page_cards = cards[-PAGE_LIMIT:]
+    else:
+        has_previous = page > 1
+        has_next = len(cards) > PAGE_LIMIT
+        page_cards = cards[:PAGE_LIMIT]
 
-    if start_index > len(cards):
+    if len(page_cards) == 0 and page > 1:
         if edit_message:
             await bot.edit_message_text(
                 chat_id=config["chat_id"],
@@ -74,13 +97,6 @@ async def send_cards_collection(
             )
         return
 
-    if end_index > len(cards):
-        end_index = len(cards)
-
-    # logger.info(f"Start index: {start_index}, end index: {end_index}")
-
-    page_cards = cards[start_index:end_index]
-
     if len(page_cards) == 0:
         logger.error("No cards: empty page")
         if edit_message:
@@ -105,22 +121,22 @@ async def send_cards_collection(
         )
 
     end_btns = []
-    if page > 1:
+    if has_previous:
         end_btns.append(
             InlineKeyboardButton(
                 text="<-",
                 callback_data=OpenCardsCollection(
-                    owner_id=user.user_id, page=page - 1
+                    owner_id=user.user_id, page=page - 1, before=page_cards[0].number
                 ).pack(),
             )
         )
 
-    if end_index < len(cards):
+    if has_next:
         end_btns.append(
             InlineKeyboardButton(
                 text="->",
                 callback_data=OpenCardsCollection(
-                    owner_id=user.user_id, page=page + 1
+                    owner_id=user.user_id, page=page + 1, after=page_cards[-1].number
                 ).pack(),
             )
         )
@@ -131,14 +147,14 @@ async def send_cards_collection(
     if edit_message:
         await bot.edit_message_text(
             chat_id=config["chat_id"],
-            text="Список карточек:",
+            text=f"Список карточек ({user.cards_count}):",
             reply_markup=kb.as_markup(),
             message_id=message_id,
         )
     else:
         await bot.send_message(
             config["chat_id"],
-            "Список карточек:",
+            f"Список карточек ({user.cards_count}):",
             reply_markup=kb.as_markup(),
             reply_to_message_id=message_id,
         )
@@ -146,7 +162,7 @@ async def send_cards_collection(
 
 
 async def send_card_info(
-    session: Session,
+    session: AsyncSession,
     card_number: int,
     message_id: int,
     direct: bool = True,
@@ -155,33 +171,54 @@ async def send_card_info(
     if user_id is None and direct:
         raise ValueError("Direct message must have user_id")
 
-    card: SavedCard | None = get_card_by_number(session, card_number)
-    if card is None:
+    card_with_owner = await get_card_with_owner(session, card_number)
+    if card_with_owner is None:
         await bot.send_message(
             config["chat_id"], "Карточка не найдена", reply_to_message_id=message_id
         )
         return 0
-
-    if not os.path.exists(f"output/{card.number}.png"):
+    card, owner, card_file = card_with_owner
+    chat_id = config["chat_id"] if not direct else user_id
+    caption = get_card_desciption_html(card, owner)
+    render_config = card_render_config(card)
+    key = render_key(render_config)
+
+    # A file id uploaded from older assets shows a stale image.
+    if card_file is not None and card_file.render_key == key:
+        try:
+            await bot.send_photo(
+                chat_id=chat_id,  # type: ignore
+                photo=card_file.file_id,
+                caption=caption,
+                reply_to_message_id=message_id if not direct else None,
+                parse_mode="HTML",
+            )
+            return 2
+        except TelegramBadRequest as exc:
+            # Upload the image again; a good upload replaces the stale id.
+            logger.warning(f"Card #{card.number} file id rejected: {exc!r}")
+        except (TelegramForbiddenError, TelegramNotFound) as exc:
+            logger.warning(repr(exc))
+            return 1
+
+    if key not in render_cache:
         await bot.send_chat_action(config["chat_id"], "upload_photo")
 
-        render_config = RenderConfig(
-            base_color=get_base_color(card.base_color.value),
-            background_type=card.background.value,
-            rarity=card.rarity.value,
-            nickname=card.nickname,
-            number=card.number,
+    try:
+        image_path = await render_cached(render_config)
+    except RenderQueueFull:
+        await bot.send_message(
+            config["chat_id"],
+            "Бот сейчас перегружен, попробуйте позже",
+            reply_to_message_id=message_id,
         )
-
-        rendered = render(render_config)
-
-        rendered.save(f"output/{card.number}.png")
+        return 0
 
     try:
-        await bot.send_photo(
-            chat_id=config["chat_id"] if not direct else user_id,  # type: ignore
-            photo=FSInputFile(f"output/{card.number}.png"),
-            caption=get_card_desciption_html(session, card),
+        sent = await bot.send_photo(
+            chat_id=chat_id,  # type: ignore
+            photo=FSInputFile(image_path),
+            caption=caption,
             reply_to_message_id=message_id if not direct else None,
             parse_mode="HTML",
         )
@@ -189,6 +226,9 @@ async def send_card_info(
         logger.warning(repr(exc))
         return 1
 
+    if sent.photo and card.number is not None:
+        await save_card_file_id(session, card.number, sent.photo[-1].file_id, key)
+
     return 2
 
     # if direct:
@@ -203,11 +243,20 @@ async def render_custom_card(
     )
     await bot.send_chat_action(config["chat_id"], "upload_photo")
 
-    rendered = render(render_config)
-
-    uid = str(uuid4())
+    key = render_key(render_config)
+    # A render already cached is sent from disk; a one-off render is not
+    # kept and goes up straight from memory.
+    image_path = render_cache.get(key)
+    if image_path is not None:
+        media: InputFile = FSInputFile(image_path)
+    else:
+        try:
+            encoded = await render_async(render_config)
+        except RenderQueueFull:
+            return await tmsg.edit_text("Бот сейчас перегружен, попробуйте позже")
+        media = BufferedInputFile(encoded.data, f"{key}.{encoder_config.extension}")
 
-    rendered.save(f"output/{uid}.png")
+    logger.info(f"Render {key}: {render_config}")
 
     # await bot.send_photo(
     #     chat_id=config["chat_id"],
@@ -218,93 +267,136 @@ async def render_custom_card(
     # )
     await tmsg.edit_media(
         media=InputMediaPhoto(
-            media=FSInputFile(f"output/{uid}.png"),
-            caption=text(hbold("Render UUID:"), hcode(uid)),
+            media=media,
+            caption=text(hbold("Render ID:"), hcode(key)),
             parse_mode="HTML",
         ),
     )
 
 
-async def gen_and_send_card(session: Session, user_id: int, message_id: int):
+def cooldown_text(user: SavedUser) -> str | None:
+    cooldown_end = user.last_card + timedelta(seconds=config["cooldown"])
+    if cooldown_end <= datetime.now():
+        return None
+
+    remaining_seconds = (cooldown_end - datetime.now()).total_seconds()
+    last_seconds = remaining_seconds % 60
+    remaining_minutes = (remaining_seconds - last_seconds) / 60
+    last_minutes = remaining_minutes % 60
+    remaining_hours = (remaining_minutes - last_minutes) / 60
+    last_hours = remaining_hours
+
+    str_time = f"{round(last_hours)} ч. / {round(last_minutes)} м. / {round(last_seconds)}с."
+
+    return f"Вы сможете получить карточку только через {str_time}"
+
+
+def get_user_lock(user_id: int) -> asyncio.Lock:
+    lock = user_locks.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        user_locks[user_id] = lock
+    return lock
+
+
+async def gen_and_send_card(session: AsyncSession, user_id: int, message_id: int):
     msg = await bot.send_message(
         config["chat_id"], "Создаю карточку...", reply_to_message_id=message_id
     )
     await bot.send_chat_action(config["chat_id"], "upload_photo")
 
-    async with gen_card_lock:
-        user: SavedUser | None = get_user_by_id(session, user_id)
+    lock = get_user_lock(user_id)
+    wait_start = perf_counter()
+    async with lock:
+        user_lock_wait_seconds.observe(perf_counter() - wait_start)
+        user: SavedUser | None = await get_user_by_id(session, user_id)
         if user is None:
             return await msg.edit_text("Не удалось найти пользователя")
-        if user.last_card + timedelta(seconds=config["cooldown"]) > datetime.now():
-            remaining_seconds = (
-                user.last_card + timedelta(seconds=config["cooldown"]) - datetime.now()
-            ).total_seconds()
-            last_seconds = remaining_seconds % 60
-            remaining_minutes = (remaining_seconds - last_seconds) / 60
-            last_minutes = remaining_minutes % 60
-            remaining_hours = (remaining_minutes - last_minutes) / 60
-            last_hours = remaining_hours
-
-            str_time = f"{round(last_hours)} ч. / {round(last_minutes)} м. / {round(last_seconds)}с."
 
-            return await msg.edit_text(
-                f"Вы сможете получить карточку только через {str_time}"
-            )
-
-        last_card = get_last_number_card(session)
-        if last_card is None:
-            number: int = 1
-        else:
-            if last_card.number is None:
-                number: int = 1
-            else:
-                number: int = last_card.number + 1
+        wait_text = cooldown_text(user)
+        if wait_text is not None:
+            return await msg.edit_text(wait_text)
 
-        if number > 2000:
+        previous_last_card = user.last_card
+        if not await claim_last_card_time(
+            session, user_id, timedelta(seconds=config["cooldown"])
+        ):
+            await session.refresh(user)
             return await msg.edit_text(
-                "__Генерация данной коллекции завершена! Ожидайте новую коллекцию, например...__ **ⅱ𝙹ᓭ₸ᒷꖎ リᖋ₸⚍॥**",
-                parse_mode="Markdown",
+                cooldown_text(user) or "Не удалось получить карточку"
             )
 
         render_config = random_render_config()
-        render_config.number = number
-
-        # logger.info(f"Color: {render_config.base_color}")
-
-        rendered = render(render_config)
 
         if not isinstance(render_config.base_color, str):
             logger.error(f"Invalid base color: {render_config.base_color}")
             raise ValueError("Invalid base color")
 
-        rendered.save(f"output/{number}.png")
-
-        card = SavedCard(
-            user_id=user.user_id,
-            nickname=render_config.nickname,
-            number=number,
-            rarity=RarityEnum(render_config.rarity),
-            base_color=BaseColorEnum(hex_to_base_color(render_config.base_color)),
-            background=BackgroundEnum(render_config.background_type),
-        )
-
-        await msg.edit_media(
-            media=InputMediaPhoto(
-                media=FSInputFile(f"output/{render_config.number}.png"),
-                caption=get_card_desciption_html(session, card),
-                parse_mode="HTML",
-            ),
-        )
+        # The queue place is taken before the number, so a busy bot never
+        # uses up a number; once a number is taken the card is kept.
+        try:
+            with render_slot():
+                number = (await allocate_card_numbers(session))[0]
+
+                if number > 2000:
+                    await update_last_card_time(session, user_id, previous_last_card)
+                    return await msg.edit_text(
+                        "__Генерация данной коллекции завершена! Ожидайте новую коллекцию, например...__ **ⅱ𝙹ᓭ₸ᒷꖎ リᖋ₸⚍॥**",
+                        parse_mode="Markdown",
+                    )
+
+                render_config.number = number
+
+                card = SavedCard(
+                    user_id=user_id,
+                    nickname=render_config.nickname,
+                    number=number,
+                    rarity=RarityEnum(render_config.rarity),
+                    base_color=BaseColorEnum(
+                        get_catalog().hex_to_base_color(render_config.base_color)
+                    ),
+                    background=BackgroundEnum(render_config.background_type),
+                )
+                await add_card(session, card)
+
+                # logger.info(f"Color: {render_config.base_color}")
+
+                try:
+                    image_path = await render_cached(render_config, reserved=True)
+                except Exception:
+                    await msg.edit_text(
+                        f"Карточка #{number} сохранена, но её не удалось отрисовать. "
+                        "Посмотрите её позже в коллекции"
+                    )
+                    raise
+        except RenderQueueFull:
+            await update_last_card_time(session, user_id, previous_last_card)
+            return await msg.edit_text("Бот сейчас перегружен, попробуйте позже")
 
-        add_card(session, card)
-        update_last_card_time(session, user.user_id)
+        try:
+            sent = await msg.edit_media(
+                media=InputMediaPhoto(
+                    media=FSInputFile(image_path),
+                    caption=get_card_desciption_html(card, user),
+                    parse_mode="HTML",
+                ),
+            )
+        except (TelegramForbiddenError, TelegramNotFound, TelegramBadRequest) as exc:
+            # The card stays saved; it is uploaded again when next shown.
+            logger.warning(f"Card #{number} not sent: {exc!r}")
+            return
+
+        if isinstance(sent, Message) and sent.photo:
+            await save_card_file_id(
+                session, number, sent.photo[-1].file_id, render_key(render_config)
+            )
 
 
 async def handle_chat(chat: Chat, enable_private: bool = False) -> bool:
-    logger.info(chat.id)
+    logger.trace(chat.id)
 
     if chat.type == "private" and enable_private:
-        logger.info("Private chat, enabled")
+        logger.trace("Private chat, enabled")
         return True
 
     if chat.type == "private":
@@ -330,46 +422,63 @@ async def handle_chat(chat: Chat, enable_private: bool = False) -> bool:
     return True
 
 
-async def handle_user(session: Session, user: User | None) -> bool:
+async def handle_user(session: AsyncSession, user: User | None) -> bool:
     if user is None:
         return True
     if user.id == 42777:
         return False
     # print(user.id)
-    saved_user: SavedUser | None = get_user_by_id(session, user.id)
+    if known_users.touch(user.id):
+        return True
+    saved_user: SavedUser | None = await get_user_by_id(session, user.id)
     if saved_user is None:
         new_user = SavedUser(user_id=user.id, username=user.username)
-        add_user(session, new_user)
+        await add_user(session, new_user)
+        known_users.put(user.id, user.username)
         return True
+    known_users.put(saved_user.user_id, saved_user.username)
     return True
 
 
+async def load_known_users(session: AsyncSession):
+    for user_id, username in await get_usernames(session, known_users.maxsize):
+        known_users.put(user_id, username)
+    logger.info(f"Known users loaded: {len(known_users)}")
+
+
 def player_rarity_by_nickname(nickname: str) -> PlayerRarityEnum | None:
-    for player_rarity, player_nicknames in index["players"].items():
-        if nickname in player_nicknames:
-            return PlayerRarityEnum(player_rarity)
-    return None
+    player_rarity = get_catalog().player_rarity_by_nickname.get(nickname)
+    if player_rarity is None:
+        return None
+    return PlayerRarityEnum(player_rarity)
+
 
+def format_chance(probability: float) -> str:
+    return f"{probability * 100:.3g}%"
 
-def get_card_desciption(session: Session, card: SavedCard) -> str:
+
+def get_card_desciption(card: SavedCard, owner: SavedUser | None) -> str:
     msg = f"Номер: #{card.number}\n"
 
     msg += f"Игрок: {card.nickname}\n"
 
-    base_color_chance = index["chances"]["base_colors"][card.base_color.value]
-    msg += (
-        f"Цвет: {names['base_colors'][card.base_color.value]} ({base_color_chance}%)\n"
-    )
+    catalog = get_catalog()
+    names = catalog.names
 
-    background_chance = index["chances"]["backgrounds"][card.background.value]
+    base_color_chance = format_chance(
+        catalog.chance("base_colors", card.base_color.value)
+    )
     msg += (
-        f"Фон: {names['backgrounds'][card.background.value]} ({background_chance}%)\n"
+        f"Цвет: {names['base_colors'][card.base_color.value]} ({base_color_chance})\n"
     )
 
-    rarity_chance = index["chances"]["rarities"][card.rarity.value]
-    msg += f"Редкость: {names['rarities'][card.rarity.value]} ({rarity_chance}%)\n"
+    background_chance = format_chance(
+        catalog.chance("backgrounds", card.background.value)
+    )
+    msg += f"Фон: {names['backgrounds'][card.background.value]} ({background_chance})\n"
 
-    owner = get_user_by_id(session, card.user_id)
+    rarity_chance = format_chance(catalog.chance("rarities", card.rarity.value))
+    msg += f"Редкость: {names['rarities'][card.rarity.value]} ({rarity_chance})\n"
 
     if owner is None:
         logger.info(card.user_id)
@@ -384,39 +493,63 @@ def get_card_desciption(session: Session, card: SavedCard) -> str:
     return msg
 
 
-def get_card_desciption_html(session: Session, card: SavedCard) -> str:
+def get_card_desciption_html(card: SavedCard, owner: SavedUser | None) -> str:
+    if owner is None or card.number is None:
+        return make_card_desciption_html(card, owner)
+
+    key = (card.number, owner.username)
+    caption = card_captions.get(key)
+    if caption is None:
+        caption = make_card_desciption_html(card, owner)
+        card_captions.put(key, caption)
+    return caption
+
+
+def forget_card_captions(username: str | None):
+    """Drop cached captions naming `username` as the owner."""
+    for key in card_captions.keys():
+        if key[1] == username:
+            card_captions.pop(key)
+
+
+def make_card_desciption_html(card: SavedCard, owner: SavedUser | None) -> str:
     # msg = f"Номер: {hcode(str(card.number))}\n"
     msg = text(hbold("Номер:"), "#" + str(card.number), "\n")
 
     # msg += f"Игрок: {card.nickname}\n"
     msg += text(hbold("Игрок:"), hcode(card.nickname), "\n")
 
-    base_color_chance = index["chances"]["base_colors"][card.base_color.value]
+    catalog = get_catalog()
+    names = catalog.names
+
+    base_color_chance = format_chance(
+        catalog.chance("base_colors", card.base_color.value)
+    )
     # msg += f"Цвет: {names['base_colors'][card.base_color.value]} ({base_color_chance}%)\n"
     msg += text(
         hbold("Цвет:"),
         hcode(names["base_colors"][card.base_color.value]),
-        f"({base_color_chance}%)\n",
+        f"({base_color_chance})\n",
     )
 
-    background_chance = index["chances"]["backgrounds"][card.background.value]
+    background_chance = format_chance(
+        catalog.chance("backgrounds", card.background.value)
+    )
     # msg += f"Фон: {names['backgrounds'][card.background.value]} ({background_chance}%)\n"
     msg += text(
         hbold("Фон:"),
         hcode(names["backgrounds"][card.background.value]),
-        f"({background_chance}%)\n",
+        f"({background_chance})\n",
     )
 
-    rarity_chance = index["chances"]["rarities"][card.rarity.value]
+    rarity_chance = format_chance(catalog.chance("rarities", card.rarity.value))
     # msg += f"Редкость: {names['rarities'][card.rarity.value]} ({rarity_chance}%)\n"
     msg += text(
         hbold("Редкость:"),
         hcode(names["rarities"][card.rarity.value]),
-        f"({rarity_chance}%)\n",
+        f"({rarity_chance})\n",
     )
 
-    owner = get_user_by_id(session, card.user_id)
-
     if owner is None:
         logger.info(card.user_id)
         return msg
@@ -1,31 +1,245 @@
-from PIL import ImageFont
+from collections import OrderedDict
+from collections.abc import Iterable
+from dataclasses import dataclass
+from threading import Lock
+from time import monotonic
+from typing import Generic, TypeVar
 
-# images: dict[str, Image.Image] = {}
+from loguru import logger
+from PIL import Image, ImageFont
+from PIL.Image import Image as ImageType
 
+from .catalog import get_catalog
+from .config import ASSET_WIDTH, HEIGHT, WIDTH, config
 
-# img = Image.open("assets/outline.png")
-# images["assets/outline.png"] = img
-# img = Image.open("assets/center.png")
-# images["assets/center.png"] = img
-# img = Image.open("assets/base.png")
-# images["assets/base.png"] = img
+KT = TypeVar("KT")
+VT = TypeVar("VT")
 
+# Resize layers to the output resolution once at load, so every render
+# stage works on output-sized images and no final resample is needed.
+PRESCALE_ASSETS: bool = config.get("prescale_assets", False)
 
-# for rarity in index["chances"]["rarities"].keys():
-#     img = Image.open(f"assets/rarity/{rarity}.png")
-#     images[f"assets/rarity/{rarity}.png"] = img
 
-# for background in index["chances"]["backgrounds"].keys():
-#     img = Image.open(f"assets/background/{background}.png")
-#     images[f"assets/background/{background}.png"] = img
+class LRUCache(Generic[KT, VT]):
+    """Thread-safe LRU mapping. `maxsize=None` keeps every entry; with `ttl`
+    set, entries are dropped that many seconds after they were put."""
 
-# for player_rarity in index["players"].keys():
-#     for player in index["players"][player_rarity]:
-#         skin_img = Image.open(f"assets/skin/{player}.png")
-#         images[f"assets/skin/{player}.png"] = skin_img
+    def __init__(self, maxsize: int | None = None, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[KT, VT] = OrderedDict()
+        self._expires: dict[KT, float] = {}
+        self._lock = Lock()
 
-#         nickname_img = Image.open(f"assets/nickname/{player}.png")
-#         images[f"assets/nickname/{player}.png"] = nickname_img
+    def _expired(self, key: KT) -> bool:
+        if self.ttl is None or key not in self._data:
+            return False
+        if self._expires[key] > monotonic():
+            return False
+        del self._data[key]
+        del self._expires[key]
+        return True
 
+    def get(self, key: KT) -> VT | None:
+        with self._lock:
+            self._expired(key)
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
 
-number_font = ImageFont.truetype("assets/font/DOSIyagiBoldface.ttf", size=58)
+    def touch(self, key: KT) -> bool:
+        """Mark `key` as recently used; return whether it is cached."""
+        with self._lock:
+            if self._expired(key) or key not in self._data:
+                self.misses += 1
+                return False
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def put(self, key: KT, value: VT):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if self.ttl is not None:
+                self._expires[key] = monotonic() + self.ttl
+            if self.maxsize is not None:
+                while len(self._data) > self.maxsize:
+                    oldest, _ = self._data.popitem(last=False)
+                    self._expires.pop(oldest, None)
+
+    def pop(self, key: KT) -> VT | None:
+        with self._lock:
+            self._expires.pop(key, None)
+            return self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+
+    def keys(self) -> list[KT]:
+        with self._lock:
+            return list(self._data.keys())
+
+    def values(self) -> list[VT]:
+        with self._lock:
+            return list(self._data.values())
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def __contains__(self, key: KT) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+@dataclass(frozen=True)
+class Layer:
+    """Card layer cropped to its visible area and split into the colour and
+    alpha mask that `Image.paste` takes, so renders never convert it again.
+
+    Layers are shared between renders and must never be modified in place.
+    """
+
+    rgb: ImageType
+    mask: ImageType
+    offset: tuple[int, int]
+    size: tuple[int, int]
+
+    @classmethod
+    def from_image(
+        cls, image: ImageType, offset: tuple[int, int], size: tuple[int, int]
+    ) -> "Layer":
+        return cls(
+            rgb=image.convert("RGB"),
+            mask=image.getchannel("A"),
+            offset=offset,
+            size=size,
+        )
+
+    @property
+    def image(self) -> ImageType:
+        return Image.merge("RGBA", (*self.rgb.split(), self.mask))
+
+    @property
+    def nbytes(self) -> int:
+        return self.rgb.width * self.rgb.height * 4
+
+
+def load_layer(path: str) -> Layer:
+    with Image.open(path) as img:
+        img = img.convert("RGBA")
+    if PRESCALE_ASSETS and img.size != (WIDTH, HEIGHT):
+        img = img.resize((WIDTH, HEIGHT))
+    size = img.size
+    bbox = img.getbbox(alpha_only=True) or (0, 0, 1, 1)
+    if bbox != (0, 0, *size):
+        img = img.crop(bbox)
+    return Layer.from_image(img, offset=(bbox[0], bbox[1]), size=size)
+
+
+def static_layer_paths() -> list[str]:
+    catalog = get_catalog()
+    paths = ["assets/outline.png", "assets/center.png", "assets/base.png"]
+    paths.extend(catalog.rarity_paths.values())
+    paths.extend(catalog.background_paths.values())
+    return paths
+
+
+def player_layer_paths() -> list[str]:
+    catalog = get_catalog()
+    paths = []
+    for nickname in catalog.nicknames:
+        paths.append(catalog.skin_paths[nickname])
+        paths.append(catalog.nickname_paths[nickname])
+    return paths
+
+
+# Card frame, rarities and backgrounds: few and always needed.
+static_layers: dict[str, Layer] = {}
+# Skins and nicknames: one pair per player, bounded by `asset_cache_size`.
+player_layers: LRUCache[str, Layer] = LRUCache(config.get("asset_cache_size"))
+
+
+def get_layer(path: str) -> Layer:
+    if path.startswith(("assets/skin/", "assets/nickname/")):
+        layer = player_layers.get(path)
+        if layer is None:
+            layer = load_layer(path)
+            player_layers.put(path, layer)
+        return layer
+
+    layer = static_layers.get(path)
+    if layer is None:
+        layer = load_layer(path)
+        static_layers[path] = layer
+    return layer
+
+
+def warm_up():
+    """Load the layers the catalog needs that are not cached yet."""
+    for path in static_layer_paths():
+        if path not in static_layers:
+            static_layers[path] = load_layer(path)
+
+    for path in player_layer_paths():
+        if (
+            player_layers.maxsize is not None
+            and len(player_layers) >= player_layers.maxsize
+        ):
+            break
+        if path not in player_layers:
+            player_layers.put(path, load_layer(path))
+
+    logger.info(f"Assets loaded: {asset_stats()}")
+
+
+def forget_layers(paths: Iterable[str]):
+    """Drop the cached layers of changed asset files."""
+    for path in paths:
+        static_layers.pop(path, None)
+        player_layers.pop(path)
+
+
+def asset_stats() -> dict[str, int]:
+    player_values = player_layers.values()
+    return {
+        "static_layers": len(static_layers),
+        "static_bytes": sum(layer.nbytes for layer in static_layers.values()),
+        "player_layers": len(player_values),
+        "player_bytes": sum(layer.nbytes for layer in player_values),
+        "player_hits": player_layers.hits,
+        "player_misses": player_layers.misses,
+    }
+
+
+# Telegram users already saved in the database, mapped to their username.
+known_users: LRUCache[int, str | None] = LRUCache(config.get("user_cache_size", 10000))
+# Card caption HTML by card number and owner username.
+card_captions: LRUCache[tuple[int, str | None], str] = LRUCache(
+    config.get("caption_cache_size", 1024), ttl=config.get("caption_cache_ttl", 600)
+)
+
+
+number_font = ImageFont.truetype(
+    "assets/font/DOSIyagiBoldface.ttf",
+    size=58 * WIDTH / ASSET_WIDTH if PRESCALE_ASSETS else 58,
+)
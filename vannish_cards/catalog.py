@@ -0,0 +1,185 @@
+import json
+import os
+from enum import Enum
+
+from loguru import logger
+from PIL import ImageColor
+
+from .data_types import (
+    Background,
+    BackgroundEnum,
+    BaseColor,
+    BaseColorEnum,
+    DetailNames,
+    Index,
+    PlayerRarity,
+    PlayerRarityEnum,
+    Rarity,
+    RarityEnum,
+)
+
+INDEX_PATH = "index.json"
+LANG_PATH = "lang.json"
+
+
+class Catalog:
+    """index.json and lang.json compiled for lookups: reverse maps, real
+    probabilities (weights divided by their table's total) and asset paths.
+
+    Built once and never changed; a new index means a new catalog.
+    """
+
+    def __init__(self, index: Index, names: DetailNames):
+        self.index = index
+        self.names = names
+        chances = index["chances"]
+
+        self.base_colors: list[BaseColor] = list(chances["base_colors"])
+        self.backgrounds: list[Background] = list(chances["backgrounds"])
+        self.rarities: list[Rarity] = list(chances["rarities"])
+        self.player_rarities: list[PlayerRarity] = list(chances["players"])
+        self.players = index["players"]
+        self.nicknames: list[str] = [
+            nickname
+            for player_rarity in self.player_rarities
+            for nickname in self.players.get(player_rarity, [])
+        ]
+
+        self.base_color_hex = index["base_colors"]
+        self.base_color_by_hex: dict[str, BaseColor] = {
+            color_hex: name for name, color_hex in self.base_color_hex.items()
+        }
+        self.player_rarity_by_nickname: dict[str, PlayerRarity] = {
+            nickname: player_rarity
+            for player_rarity, nicknames in self.players.items()
+            for nickname in nicknames
+        }
+
+        self.probabilities: dict[str, dict[str, float]] = {}
+        for table, weights in chances.items():
+            total = sum(weights.values()) or 1
+            self.probabilities[table] = {
+                option: weight / total for option, weight in weights.items()
+            }
+
+        self.background_paths = {
+            background: f"assets/background/{background}.png"
+            for background in self.backgrounds
+        }
+        self.rarity_paths = {
+            rarity: f"assets/rarity/{rarity}.png" for rarity in self.rarities
+        }
+        self.skin_paths = {
+            nickname: f"assets/skin/{nickname}.png" for nickname in self.nicknames
+        }
+        self.nickname_paths = {
+            nickname: f"assets/nickname/{nickname}.png" for nickname in self.nicknames
+        }
+
+    def get_base_color(self, base_color_name: BaseColor) -> str:
+        return self.base_color_hex[base_color_name]
+
+    def hex_to_base_color(self, hex: str) -> BaseColor:
+        try:
+            return self.base_color_by_hex[hex]
+        except KeyError:
+            raise ValueError(f"Invalid hex color: {hex}") from None
+
+    def chance(self, table: str, option: str) -> float:
+        return self.probabilities[table][option]
+
+    def validate(self) -> list[str]:
+        """Return every problem that would break a draw or a render."""
+        errors = []
+        tables: list[tuple[str, list[str], type[Enum]]] = [
+            ("base_colors", self.base_colors, BaseColorEnum),
+            ("backgrounds", self.backgrounds, BackgroundEnum),
+            ("rarities", self.rarities, RarityEnum),
+            ("players", self.player_rarities, PlayerRarityEnum),
+        ]
+        for table, options, enum in tables:
+            weights = self.index["chances"][table]
+            if sum(weights.values()) <= 0:
+                errors.append(f"chances.{table}: weights sum to zero")
+            values = {member.value for member in enum}
+            for option in options:
+                if option not in values:
+                    errors.append(f"chances.{table}: unknown {option!r}")
+                if not isinstance(weights[option], int) or weights[option] < 0:
+                    errors.append(f"chances.{table}.{option}: bad weight")
+                if table != "players" and option not in self.names[table]:
+                    errors.append(f"{LANG_PATH}: no name for {table}.{option}")
+
+        for name in self.base_colors:
+            color_hex = self.base_color_hex.get(name)
+            if color_hex is None:
+                errors.append(f"base_colors: no color for {name!r}")
+                continue
+            try:
+                ImageColor.getrgb(color_hex)
+            except ValueError:
+                errors.append(f"base_colors.{name}: invalid color {color_hex!r}")
+        if len(self.base_color_by_hex) != len(self.base_color_hex):
+            errors.append("base_colors: two colors share a hex value")
+
+        for player_rarity in self.player_rarities:
+            if not self.players.get(player_rarity):
+                errors.append(f"players.{player_rarity}: no players")
+        if len(self.player_rarity_by_nickname) != len(self.nicknames):
+            errors.append("players: a nickname is listed more than once")
+
+        for paths in (
+            self.background_paths,
+            self.rarity_paths,
+            self.skin_paths,
+            self.nickname_paths,
+        ):
+            for path in paths.values():
+                if not os.path.isfile(path):
+                    errors.append(f"missing asset {path}")
+        return errors
+
+    def unused_assets(self) -> list[str]:
+        """Files in the per-entry asset folders that no index entry uses."""
+        unused = []
+        for directory, paths in (
+            ("assets/background", self.background_paths),
+            ("assets/rarity", self.rarity_paths),
+            ("assets/skin", self.skin_paths),
+            ("assets/nickname", self.nickname_paths),
+        ):
+            used = set(paths.values())
+            for name in sorted(os.listdir(directory)):
+                path = f"{directory}/{name}"
+                if path not in used:
+                    unused.append(path)
+        return unused
+
+
+def load_catalog(index_path: str = INDEX_PATH, lang_path: str = LANG_PATH) -> Catalog:
+    """Read and check the index, raising ValueError if any entry is broken."""
+    with open(index_path, "r") as f:
+        index: Index = json.load(f)
+    with open(lang_path, "r") as f:
+        names: DetailNames = json.load(f)
+
+    catalog = Catalog(index, names)
+    errors = catalog.validate()
+    if errors:
+        raise ValueError(f"Invalid {index_path}:\n" + "\n".join(errors))
+    for path in catalog.unused_assets():
+        logger.warning(f"Asset not used by {index_path}: {path}")
+    return catalog
+
+
+catalog = load_catalog()
+
+
+def get_catalog() -> Catalog:
+    return catalog
+
+
+def set_catalog(new_catalog: Catalog):
+    """Make `new_catalog` current; readers see either the old or the new one."""
+    global catalog
+    catalog = new_catalog
@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import Literal, TypeAlias, TypedDict
+from typing import Literal, NotRequired, TypeAlias, TypedDict
 
 from aiogram.filters.callback_data import CallbackData
 
@@ -9,8 +9,9 @@ BaseColor: TypeAlias = Literal[
 ]
 PlayerRarity: TypeAlias = Literal["often", "common", "rare"]
 Background: TypeAlias = Literal[
-    "squares", "circles", "triangles", "diamonds", "crystals", "lines", "fee"
+    "squares", "circles", "triangles", "diamonds", "crystals", "slime", "lines", "fee"
 ]
+OutputFormat: TypeAlias = Literal["png", "webp", "jpeg"]
 
 
 class PlayerRarityEnum(str, Enum):
@@ -62,6 +63,29 @@ class Config(TypedDict):
     chat_id: int
     pool_size: int
     cooldown: int
+    asset_cache_size: NotRequired[int]
+    recolor_cache_size: NotRequired[int]
+    prescale_assets: NotRequired[bool]
+    render_executor: NotRequired[Literal["process", "thread"]]
+    render_workers: NotRequired[int]
+    render_queue_size: NotRequired[int]
+    user_cache_size: NotRequired[int]
+    caption_cache_size: NotRequired[int]
+    caption_cache_ttl: NotRequired[float]
+    output_format: NotRequired[OutputFormat]
+    output_quality: NotRequired[int]
+    output_compress_level: NotRequired[int]
+    output_max_bytes: NotRequired[int]
+    render_cache_dir: NotRequired[str]
+    render_cache_max_bytes: NotRequired[int]
+    render_cache_max_files: NotRequired[int]
+    prerender: NotRequired[bool]
+    prerender_workers: NotRequired[int]
+    metrics: NotRequired[bool]
+    metrics_host: NotRequired[str]
+    metrics_port: NotRequired[int]
+    hot_reload: NotRequired[bool]
+    hot_reload_interval: NotRequired[float]
 
 
 class Chances(TypedDict):
@@ -86,6 +110,8 @@ class DetailNames(TypedDict):
 class OpenCardsCollection(CallbackData, prefix="open_collection"):
     owner_id: int
     page: int = 1
+    after: int | None = None
+    before: int | None = None
 
 
 class OpenCard(CallbackData, prefix="open_card"):
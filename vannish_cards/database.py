@@ -1,13 +1,22 @@
-from datetime import datetime
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from time import perf_counter
 
-from sqlalchemy import Engine
-from sqlmodel import BigInteger, Column, Field, Session, SQLModel, select, update
+from loguru import logger
+from sqlalchemy import Index, event, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlmodel import BigInteger, Column, Field, SQLModel, delete, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from .data_types import (
     BackgroundEnum,
     BaseColorEnum,
     RarityEnum,
 )
+from .metrics import db_query_seconds
 
 
 class SavedUser(SQLModel, table=True):
@@ -28,65 +37,377 @@ class SavedCard(SQLModel, table=True):
     base_color: BaseColorEnum
     background: BackgroundEnum
 
+    # Collection pages are read by owner in number order.
+    __table_args__ = (Index("ix_savedcard_user_id_number", "user_id", "number"),)
 
-def prepare_database(engine: Engine):
-    SQLModel.metadata.create_all(engine)
 
+class UserRarityCount(SQLModel, table=True):
+    """Cards of one rarity owned by a user, kept in step with SavedCard."""
 
-def get_user_by_id(session: Session, user_id: int) -> SavedUser | None:
-    return session.exec(
-        select(SavedUser).where(SavedUser.user_id == user_id)
-    ).one_or_none()
+    user_id: int = Field(
+        sa_column=Column(BigInteger(), primary_key=True, autoincrement=False)
+    )
+    rarity: RarityEnum = Field(primary_key=True)
+    count: int = Field(default=0)
 
 
-def get_user_by_username(session: Session, username: str) -> SavedUser | None:
-    return session.exec(
-        select(SavedUser).where(SavedUser.username == username)
-    ).one_or_none()
+class CardFile(SQLModel, table=True):
+    """Telegram file id of a card image that has already been uploaded, and
+    the render key of the image it was uploaded from."""
 
+    number: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    file_id: str
+    render_key: str
 
-def update_username(session: Session, user_id: int, new_username: str | None):
-    session.exec(
-        update(SavedUser)
+
+class CardCounter(SQLModel, table=True):
+    name: str = Field(primary_key=True)
+    value: int = Field(default=0)
+
+
+CARD_NUMBER_COUNTER = "card_number"
+
+# asyncio drivers used when `database_uri` names a synchronous one or none.
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "postgresql": "asyncpg",
+}
+
+# INSERT constructs that support ON CONFLICT, by dialect name.
+UPSERT_INSERTS = {
+    "sqlite": sqlite.insert,
+    "postgresql": postgresql.insert,
+}
+
+
+def async_database_uri(uri: str) -> str:
+    scheme, _, rest = uri.partition("://")
+    dialect, _, driver = scheme.partition("+")
+    if dialect == "postgres":
+        dialect = "postgresql"
+    if dialect in ASYNC_DRIVERS and driver not in ASYNC_DRIVERS.values():
+        driver = ASYNC_DRIVERS[dialect]
+    return f"{dialect}+{driver}://{rest}" if driver else f"{dialect}://{rest}"
+
+
+@dataclass
+class QueryStats:
+    count: int = 0
+    seconds: float = 0.0
+
+
+# Statements executed by the current update, see `DatabaseSessionMiddleware`.
+query_stats: ContextVar[QueryStats | None] = ContextVar("query_stats", default=None)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - conn.info["query_start"].pop()
+    db_query_seconds.observe(elapsed)
+    stats = query_stats.get()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += elapsed
+
+
+def create_database_engine(uri: str, pool_size: int) -> AsyncEngine:
+    engine = create_async_engine(
+        async_database_uri(uri), pool_size=pool_size, max_overflow=50
+    )
+    event.listen(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", after_cursor_execute)
+    return engine
+
+
+def create_session(engine: AsyncEngine) -> AsyncSession:
+    # Loaded rows stay usable after commit without an implicit (sync) refresh.
+    return AsyncSession(engine, expire_on_commit=False)
+
+
+async def prepare_database(engine: AsyncEngine):
+    async with engine.begin() as connection:
+        await connection.run_sync(SQLModel.metadata.create_all)
+        # create_all skips indexes added to tables that already exist.
+        for index in SavedCard.__table__.indexes:  # type: ignore
+            await connection.run_sync(index.create, checkfirst=True)
+
+    async with create_session(engine) as session:
+        await prepare_card_counter(session)
+        await prepare_card_counts(session)
+
+
+async def prepare_card_counter(session: AsyncSession):
+    """Create the card number counter, starting after the last saved card."""
+    if await session.get(CardCounter, CARD_NUMBER_COUNTER) is not None:
+        return
+
+    last_card = await get_last_number_card(session)
+    last_number = last_card.number if last_card is not None else None
+    session.add(CardCounter(name=CARD_NUMBER_COUNTER, value=last_number or 0))
+    try:
+        await session.commit()
+    except IntegrityError:
+        # Another instance created it first.
+        await session.rollback()
+
+
+async def prepare_card_counts(session: AsyncSession):
+    """Fill the card counts of a database created before they were kept."""
+    if (await session.exec(select(UserRarityCount).limit(1))).first() is not None:
+        return
+    if (await session.exec(select(SavedCard.card_id).limit(1))).first() is None:
+        return
+
+    users = await recount_user_cards(session)
+    logger.info(f"Card counts filled for {users} users")
+
+
+async def allocate_card_numbers(session: AsyncSession, count: int = 1) -> range:
+    """Reserve `count` consecutive card numbers in one statement.
+
+    Numbers are never handed out twice, also across processes sharing the
+    database; numbers of cards that failed to be drawn are not reused.
+    """
+    statement = (
+        update(CardCounter)
+        .where(CardCounter.name == CARD_NUMBER_COUNTER)  # type: ignore
+        .values(value=CardCounter.value + count)
+        .returning(CardCounter.value)
+    )
+    result = await session.exec(statement)  # type: ignore
+    last_number: int = result.scalar_one()
+    await session.commit()
+    return range(last_number - count + 1, last_number + 1)
+
+
+async def get_user_by_id(session: AsyncSession, user_id: int) -> SavedUser | None:
+    result = await session.exec(select(SavedUser).where(SavedUser.user_id == user_id))
+    return result.one_or_none()
+
+
+async def get_usernames(
+    session: AsyncSession, limit: int | None = None
+) -> list[tuple[int, str | None]]:
+    result = await session.exec(
+        select(SavedUser.user_id, SavedUser.username).limit(limit)
+    )
+    return list(result.all())
+
+
+async def get_user_by_username(
+    session: AsyncSession, username: str
+) -> SavedUser | None:
+    result = await session.exec(select(SavedUser).where(SavedUser.username == username))
+    return result.one_or_none()
+
+
+async def update_username(
+    session: AsyncSession, user_id: int, new_username: str | None
+):
+    await session.exec(
+        update(SavedUser)  # type: ignore
         .where(SavedUser.user_id == user_id)  # type: ignore
         .values(username=new_username)
     )
-    session.commit()
+    await session.commit()
 
 
-def get_last_number_card(session: Session) -> SavedCard | None:
-    return session.exec(
+async def get_last_number_card(session: AsyncSession) -> SavedCard | None:
+    result = await session.exec(
         select(SavedCard).order_by(SavedCard.number.desc()).limit(1)  # type: ignore
-    ).first()
+    )
+    return result.first()
 
 
-def add_card(session: Session, card: SavedCard):
+async def change_card_counts(
+    session: AsyncSession, user_id: int, rarity: RarityEnum, delta: int
+):
+    await session.exec(
+        update(SavedUser)  # type: ignore
+        .where(SavedUser.user_id == user_id)  # type: ignore
+        .values(cards_count=SavedUser.cards_count + delta)
+    )
+    # One upsert, so two processes adding a user's first card of a rarity
+    # cannot both insert the row.
+    insert = UPSERT_INSERTS[session.bind.dialect.name]  # type: ignore
+    await session.exec(
+        insert(UserRarityCount)  # type: ignore
+        .values(user_id=user_id, rarity=rarity, count=delta)
+        .on_conflict_do_update(
+            index_elements=["user_id", "rarity"],
+            set_={"count": UserRarityCount.count + delta},
+        )
+    )
+
+
+async def add_card(session: AsyncSession, card: SavedCard):
     session.add(card)
-    session.commit()
+    await change_card_counts(session, card.user_id, card.rarity, 1)
+    await session.commit()
 
 
-def get_user_cards(session: Session, user_id: int) -> list[SavedCard]:
-    return list(
-        session.exec(select(SavedCard).where(SavedCard.user_id == user_id)).all()
-    )
+async def get_user_cards(session: AsyncSession, user_id: int) -> list[SavedCard]:
+    result = await session.exec(select(SavedCard).where(SavedCard.user_id == user_id))
+    return list(result.all())
+
 
+async def get_user_cards_page(
+    session: AsyncSession,
+    user_id: int,
+    limit: int,
+    after: int | None = None,
+    before: int | None = None,
+) -> list[SavedCard]:
+    """Return up to `limit` of the user's cards in number order.
 
-def add_user(session: Session, user: SavedUser):
+    `after` and `before` are card numbers from a neighbouring page, so the
+    query walks the (user_id, number) index instead of skipping rows.
+    """
+    query = select(SavedCard).where(SavedCard.user_id == user_id).limit(limit)
+    if before is not None:
+        query = query.where(SavedCard.number < before).order_by(
+            SavedCard.number.desc()  # type: ignore
+        )
+        result = await session.exec(query)
+        return list(reversed(result.all()))
+
+    if after is not None:
+        query = query.where(SavedCard.number > after)
+    result = await session.exec(query.order_by(SavedCard.number))  # type: ignore
+    return list(result.all())
+
+
+async def get_cards_page(
+    session: AsyncSession, limit: int, after: int | None = None
+) -> list[SavedCard]:
+    """Return up to `limit` cards of all users in number order."""
+    query = select(SavedCard).order_by(SavedCard.number).limit(limit)  # type: ignore
+    if after is not None:
+        query = query.where(SavedCard.number > after)
+    result = await session.exec(query)
+    return list(result.all())
+
+
+async def count_cards(session: AsyncSession) -> int:
+    result = await session.exec(select(func.count()).select_from(SavedCard))
+    return result.one()
+
+
+async def add_user(session: AsyncSession, user: SavedUser):
     session.add(user)
-    session.commit()
+    await session.commit()
 
 
-def get_card_by_number(session: Session, card_number: int) -> SavedCard | None:
-    return session.exec(
+async def get_card_by_number(
+    session: AsyncSession, card_number: int
+) -> SavedCard | None:
+    result = await session.exec(
         select(SavedCard).where(SavedCard.number == card_number)
-    ).one_or_none()
+    )
+    return result.one_or_none()
+
+
+async def get_card_with_owner(
+    session: AsyncSession, card_number: int
+) -> tuple[SavedCard, SavedUser | None, CardFile | None] | None:
+    """Return the card with this number, its owner and its uploaded image,
+    in one query."""
+    result = await session.exec(
+        select(SavedCard, SavedUser, CardFile)
+        .outerjoin(SavedUser, SavedUser.user_id == SavedCard.user_id)  # type: ignore
+        .outerjoin(CardFile, CardFile.number == SavedCard.number)  # type: ignore
+        .where(SavedCard.number == card_number)
+    )
+    row = result.first()
+    if row is None:
+        return None
+    card, owner, card_file = row
+    return card, owner, card_file
+
+
+async def save_card_file_id(
+    session: AsyncSession, card_number: int, file_id: str, render_key: str
+):
+    await session.merge(
+        CardFile(number=card_number, file_id=file_id, render_key=render_key)
+    )
+    await session.commit()
+
+
+async def delete_card(session: AsyncSession, card: SavedCard):
+    await session.delete(card)
+    await session.exec(delete(CardFile).where(CardFile.number == card.number))  # type: ignore
+    await change_card_counts(session, card.user_id, card.rarity, -1)
+    await session.commit()
+
+
+async def get_user_rarity_counts(
+    session: AsyncSession, user_id: int
+) -> dict[RarityEnum, int]:
+    result = await session.exec(
+        select(UserRarityCount).where(UserRarityCount.user_id == user_id)
+    )
+    return {row.rarity: row.count for row in result.all() if row.count > 0}
+
+
+async def recount_user_cards(session: AsyncSession) -> int:
+    """Recompute every user's card counts from SavedCard.
+
+    Returns the number of users updated.
+    """
+    cards_count = (
+        select(func.count())
+        .select_from(SavedCard)
+        .where(SavedCard.user_id == SavedUser.user_id)
+        .scalar_subquery()
+    )
+    result = await session.exec(update(SavedUser).values(cards_count=cards_count))  # type: ignore
+
+    await session.exec(delete(UserRarityCount))  # type: ignore
+    rows = await session.exec(
+        select(SavedCard.user_id, SavedCard.rarity, func.count()).group_by(
+            SavedCard.user_id,  # type: ignore
+            SavedCard.rarity,  # type: ignore
+        )
+    )
+    session.add_all(
+        UserRarityCount(user_id=user_id, rarity=rarity, count=count)
+        for user_id, rarity, count in rows.all()
+    )
+    await session.commit()
+    return result.rowcount
+
+
+async def update_last_card_time(
+    session: AsyncSession, user_id: int, last_card: datetime | None = None
+):
+    statement = (
+        update(SavedUser)
+        .where(SavedUser.user_id == user_id)  # type: ignore
+        .values(last_card=last_card if last_card is not None else datetime.now())
+    )
+    await session.exec(statement)  # type: ignore
+    await session.commit()
+
 
+async def claim_last_card_time(
+    session: AsyncSession, user_id: int, cooldown: timedelta
+) -> bool:
+    """Start the user's cooldown if the previous one has expired.
 
-def update_last_card_time(session: Session, user_id: int):
+    The check and the update are one statement, so two concurrent draws for
+    the same user (even from different processes) cannot both succeed.
+    """
+    now = datetime.now()
     statement = (
         update(SavedUser)
         .where(SavedUser.user_id == user_id)  # type: ignore
-        .values(last_card=datetime.now())
+        .where(SavedUser.last_card <= now - cooldown)  # type: ignore
+        .values(last_card=now)
     )
-    session.exec(statement)  # type: ignore
-    session.commit()
+    result = await session.exec(statement)  # type: ignore
+    await session.commit()
+    return result.rowcount == 1
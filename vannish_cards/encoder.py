@@ -0,0 +1,125 @@
+from dataclasses import dataclass
+from io import BytesIO
+from time import perf_counter
+
+from loguru import logger
+from PIL import Image
+from PIL.Image import Image as ImageType
+
+from .config import config
+from .data_types import OutputFormat
+
+# Lowest quality the target-size search may pick for lossy formats.
+MIN_QUALITY = 30
+
+EXTENSIONS: dict[OutputFormat, str] = {"png": "png", "webp": "webp", "jpeg": "jpg"}
+
+
+@dataclass(frozen=True)
+class EncoderConfig:
+    """How rendered cards are encoded.
+
+    `compress_level` (0-9) trades encode speed for size: it is the zlib level
+    for PNG, is scaled to the 0-6 `method` for WebP and turns on Huffman table
+    optimization for JPEG from 6 up. With `max_bytes` set, lossy formats
+    lower their quality until the image fits.
+    """
+
+    format: OutputFormat = "png"
+    quality: int = 90
+    compress_level: int = 6
+    max_bytes: int | None = None
+
+    @property
+    def extension(self) -> str:
+        return EXTENSIONS[self.format]
+
+
+@dataclass(frozen=True)
+class EncodedImage:
+    data: bytes
+    format: OutputFormat
+    quality: int | None
+    seconds: float
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+
+encoder_config = EncoderConfig(
+    format=config.get("output_format", "png"),
+    quality=config.get("output_quality", 90),
+    compress_level=config.get("output_compress_level", 6),
+    max_bytes=config.get("output_max_bytes"),
+)
+
+
+def save_image(image: ImageType, encoder: EncoderConfig, quality: int) -> bytes:
+    buffer = BytesIO()
+    if encoder.format == "png":
+        image.save(buffer, format="PNG", compress_level=encoder.compress_level)
+    elif encoder.format == "webp":
+        image.save(
+            buffer,
+            format="WEBP",
+            quality=quality,
+            method=round(encoder.compress_level * 6 / 9),
+        )
+    else:
+        image.save(
+            buffer,
+            format="JPEG",
+            quality=quality,
+            optimize=encoder.compress_level >= 6,
+        )
+    return buffer.getvalue()
+
+
+def flatten(image: ImageType) -> ImageType:
+    """Put the transparent card corners on white for formats without alpha."""
+    if image.mode != "RGBA":
+        return image.convert("RGB")
+    flat = Image.new("RGB", image.size, "white")
+    flat.paste(image, mask=image.getchannel("A"))
+    return flat
+
+
+def encode(image: ImageType, encoder: EncoderConfig = encoder_config) -> EncodedImage:
+    start = perf_counter()
+    if encoder.format == "jpeg":
+        image = flatten(image)
+
+    quality = encoder.quality
+    data = save_image(image, encoder, quality)
+
+    if encoder.max_bytes is not None and len(data) > encoder.max_bytes:
+        if encoder.format == "png":
+            logger.warning(
+                f"PNG card is {len(data)} bytes, over output_max_bytes "
+                f"({encoder.max_bytes}); use a lossy output_format to cap size"
+            )
+        else:
+            # Binary search for the highest quality that fits the budget.
+            low, high = MIN_QUALITY, encoder.quality - 1
+            best = None
+            while low <= high:
+                middle = (low + high) // 2
+                candidate = save_image(image, encoder, middle)
+                if len(candidate) <= encoder.max_bytes:
+                    best = (middle, candidate)
+                    low = middle + 1
+                else:
+                    high = middle - 1
+            if best is None:
+                quality = MIN_QUALITY
+                data = save_image(image, encoder, quality)
+            else:
+                quality, data = best
+
+    return EncodedImage(
+        data=data,
+        format=encoder.format,
+        quality=quality if encoder.format != "png" else None,
+        seconds=perf_counter() - start,
+    )
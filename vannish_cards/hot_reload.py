@@ -0,0 +1,111 @@
+import asyncio
+import os
+
+from loguru import logger
+
+from .cache import card_captions
+from .catalog import INDEX_PATH, LANG_PATH, get_catalog, load_catalog, set_catalog
+from .config import config
+from .prerender import restart_prerender
+from .render_cache import hash_assets, set_asset_fingerprint
+from .render_executor import reload_executor
+
+HOT_RELOAD: bool = config.get("hot_reload", False)
+HOT_RELOAD_INTERVAL: float = config.get("hot_reload_interval", 5.0)
+
+FileStamp = tuple[int, int]
+
+
+def snapshot() -> dict[str, FileStamp]:
+    """Modification time and size of every file the catalog is built from."""
+    files = {}
+    for path in (INDEX_PATH, LANG_PATH):
+        stat = os.stat(path)
+        files[path] = (stat.st_mtime_ns, stat.st_size)
+    for root, _, names in os.walk("assets"):
+        for name in names:
+            path = f"{root}/{name}"
+            stat = os.stat(path)
+            files[path] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def changed_paths(old: dict[str, FileStamp], new: dict[str, FileStamp]) -> set[str]:
+    return {path for path in old.keys() | new.keys() if old.get(path) != new.get(path)}
+
+
+async def reload_catalog(changed: set[str]) -> bool:
+    """Swap in a catalog built from the changed files; return whether it was
+    valid. Only caches built from `changed` are dropped."""
+    try:
+        catalog = await asyncio.to_thread(load_catalog)
+    except Exception as exc:
+        # Parseable but malformed files fail with KeyError, TypeError and
+        # the like, not only ValueError.
+        logger.error(f"Catalog not reloaded, keeping the current one: {exc!r}")
+        return False
+
+    changed_assets = {path for path in changed if path.startswith("assets/")}
+    if any(path.startswith("assets/font/") for path in changed_assets):
+        logger.warning("Font changes are only picked up after a restart")
+
+    # Hashed off the loop now, and made current together with the catalog.
+    fingerprint = await asyncio.to_thread(hash_assets) if changed_assets else None
+    old_catalog = get_catalog()
+
+    def switch():
+        set_catalog(catalog)
+        if fingerprint is not None:
+            set_asset_fingerprint(fingerprint)
+        if INDEX_PATH in changed or LANG_PATH in changed:
+            card_captions.clear()
+        if fingerprint is not None or INDEX_PATH in changed:
+            # Render keys changed; saved cards need images for the new ones.
+            restart_prerender()
+
+    await reload_executor(catalog, changed_assets, switch)
+
+    logger.info(
+        f"Catalog reloaded: {len(changed)} files changed, "
+        f"players {len(old_catalog.nicknames)} -> {len(catalog.nicknames)}, "
+        f"backgrounds {len(old_catalog.backgrounds)} -> {len(catalog.backgrounds)}"
+    )
+    return True
+
+
+async def watch_catalog():
+    """Poll index.json, lang.json and assets/ and reload them when changed.
+
+    A change is applied once a poll finds nothing new, so files still
+    being copied are not read half-written. A rejected change is kept and
+    tried again with the next change, not on every poll.
+    """
+    files = await asyncio.to_thread(snapshot)
+    pending: set[str] = set()
+    rejected = False
+    logger.info(f"Watching catalog files every {HOT_RELOAD_INTERVAL} s")
+    while True:
+        await asyncio.sleep(HOT_RELOAD_INTERVAL)
+        try:
+            new_files = await asyncio.to_thread(snapshot)
+        except OSError as exc:
+            # A file was replaced between listing and stat; look again later.
+            logger.debug(f"Catalog snapshot failed: {exc}")
+            continue
+
+        changed = changed_paths(files, new_files)
+        files = new_files
+        if changed:
+            pending |= changed
+            rejected = False
+            continue
+        if not pending or rejected:
+            continue
+
+        try:
+            if await reload_catalog(pending):
+                pending.clear()
+            else:
+                rejected = True
+        except Exception as exc:
+            logger.exception(exc)
@@ -12,37 +12,59 @@ from aiogram.types import (
     Message,
 )
 from loguru import logger
-from sqlalchemy import Engine
-from sqlmodel import Session, SQLModel, create_engine
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from .bot import bot, dp
 from .bot_utils import (
+    forget_card_captions,
     gen_and_send_card,
     handle_chat,
     handle_user,
+    load_known_users,
     render_custom_card,
     send_card_info,
     send_cards_collection,
 )
-from .config import config, get_base_color
+from .cache import known_users
+from .catalog import get_catalog
+from .config import config
 from .data_types import Background, OpenCard, OpenCardsCollection, Rarity
 from .database import (
     SavedUser,
     add_user,
+    create_database_engine,
+    create_session,
     get_user_by_id,
     get_user_by_username,
+    prepare_database,
+    recount_user_cards,
     update_username,
 )
 from .filters import validate_user_id, validate_username
+from .hot_reload import HOT_RELOAD, watch_catalog
+from .metrics import METRICS_ENABLED, start_metrics_server
+from .middlewares import (
+    DatabaseSessionMiddleware,
+    HandlerMetricsMiddleware,
+    TelegramMetricsMiddleware,
+)
+from .prerender import start_prerender, stop_prerender
 from .render import RenderConfig
+from .render_cache import asset_fingerprint, render_cache
+from .render_executor import (
+    RENDER_WORKERS,
+    RenderQueueFull,
+    shutdown_executor,
+    start_executor,
+    worker_asset_stats,
+)
 
 DIRECT = True
 
 
 @dp.chat_member()
-async def chat_member(update: ChatMemberUpdated, engine: Engine):
-    session = Session(engine)
-
+async def chat_member(update: ChatMemberUpdated, session: AsyncSession):
     if not await handle_chat(update.chat):
         return
 
@@ -61,25 +83,30 @@ async def chat_member(update: ChatMemberUpdated, engine: Engine):
         ChatMemberStatus.MEMBER,
         ChatMemberStatus.RESTRICTED,
     ):
-        user = get_user_by_id(session, update.new_chat_member.user.id)
+        user = await get_user_by_id(session, update.new_chat_member.user.id)
         if user is None:
             new_user = SavedUser(
                 user_id=update.from_user.id, username=update.from_user.username
             )
 
-            add_user(session, new_user)
+            await add_user(session, new_user)
+            known_users.put(new_user.user_id, new_user.username)
             return
 
     if update.old_chat_member.user.username != update.new_chat_member.user.username:
-        update_username(
+        await update_username(
             session,
             update.new_chat_member.user.id,
             update.new_chat_member.user.username,
         )
+        known_users.put(
+            update.new_chat_member.user.id, update.new_chat_member.user.username
+        )
+        forget_card_captions(update.old_chat_member.user.username)
 
 
 @dp.my_chat_member()
-async def my_chat_member(update: ChatMemberUpdated, engine: Engine):
+async def my_chat_member(update: ChatMemberUpdated, session: AsyncSession):
     if not await handle_chat(update.chat):
         return
 
@@ -88,8 +115,7 @@ async def my_chat_member(update: ChatMemberUpdated, engine: Engine):
 
 
 @dp.message(Command("start"))
-async def start(message: Message, engine: Engine):
-    session = Session(engine)
+async def start(message: Message, session: AsyncSession):
     # print(message.chat.id)
 
     if message.forward_from or message.forward_from_chat or message.forward_sender_name:
@@ -106,9 +132,7 @@ async def start(message: Message, engine: Engine):
 
 
 @dp.message(Command("коллекция", "collection", "карточки", "cards", prefix="/!."))
-async def check_collection(message: Message, engine: Engine):
-    session = Session(engine)
-
+async def check_collection(message: Message, session: AsyncSession):
     if message.forward_from or message.forward_from_chat or message.forward_sender_name:
         return
 
@@ -122,9 +146,8 @@ async def check_collection(message: Message, engine: Engine):
     if message.text is None:
         return
     args: list[str] = message.text.split()
-    session = Session(engine)
     if len(args) == 1:
-        user: SavedUser | None = get_user_by_id(session, from_user.id)
+        user: SavedUser | None = await get_user_by_id(session, from_user.id)
         if user is None:
             logger.error("User not found")
             return await message.reply("Пользователь не найден!")
@@ -132,7 +155,7 @@ async def check_collection(message: Message, engine: Engine):
         username = args[1][1:]
         if not validate_username(username):
             return await message.reply("Некорректный юзернейм!")
-        user: SavedUser | None = get_user_by_username(session, username)
+        user: SavedUser | None = await get_user_by_username(session, username)
         if user is None:
             return await message.reply("Пользователь не найден!")
 
@@ -141,7 +164,7 @@ async def check_collection(message: Message, engine: Engine):
         if not validate_user_id(user_id):
             return await message.reply("Некорректный ID!")
         user_id = int(user_id)
-        user: SavedUser | None = get_user_by_id(session, user_id)
+        user: SavedUser | None = await get_user_by_id(session, user_id)
         if user is None:
             return await message.reply("Пользователь не найден!")
 
@@ -149,20 +172,18 @@ async def check_collection(message: Message, engine: Engine):
 
 
 @dp.message(Command("card", "карточка", prefix="/!."))
-async def simple_card(message: Message, engine: Engine):
+async def simple_card(message: Message, session: AsyncSession):
     if message.text is None:
         return
     if len(message.text.split()) == 1:
-        return await take_card(message, engine)
-    return await check_card(message, engine)
+        return await take_card(message, session)
+    return await check_card(message, session)
 
 
 @dp.message(
     Command("инфо_карточки", "card_info", "check_card", "карт_инфо", prefix="/!.")
 )
-async def check_card(message: Message, engine: Engine):
-    session = Session(engine)
-
+async def check_card(message: Message, session: AsyncSession):
     if message.forward_from or message.forward_from_chat or message.forward_sender_name:
         return
 
@@ -205,9 +226,7 @@ async def check_card(message: Message, engine: Engine):
         "взять_карточку", "get_card", "получить_карточку", "take_card", prefix="/!."
     )
 )
-async def take_card(message: Message, engine: Engine):
-    session = Session(engine)
-
+async def take_card(message: Message, session: AsyncSession):
     if message.forward_from or message.forward_from_chat or message.forward_sender_name:
         return
 
@@ -220,7 +239,7 @@ async def take_card(message: Message, engine: Engine):
     if message.from_user is None:
         raise ValueError("User not found")
 
-    saved_user: SavedUser | None = get_user_by_id(session, message.from_user.id)
+    saved_user: SavedUser | None = await get_user_by_id(session, message.from_user.id)
 
     if saved_user is None:
         raise ValueError("User not found")
@@ -229,9 +248,9 @@ async def take_card(message: Message, engine: Engine):
 
 
 @dp.callback_query(CallbackQueryFilter(callback_data=OpenCardsCollection))
-async def cards_collection_callback(callback_query: CallbackQuery, engine: Engine):
-    session = Session(engine)
-
+async def cards_collection_callback(
+    callback_query: CallbackQuery, session: AsyncSession
+):
     if callback_query.message is None:
         return
 
@@ -248,7 +267,7 @@ async def cards_collection_callback(callback_query: CallbackQuery, engine: Engin
         return
 
     data = OpenCardsCollection.unpack(callback_query.data)
-    owner = get_user_by_id(session, data.owner_id)
+    owner = await get_user_by_id(session, data.owner_id)
     if owner is None:
         return
     await send_cards_collection(
@@ -257,13 +276,13 @@ async def cards_collection_callback(callback_query: CallbackQuery, engine: Engin
         callback_query.message.message_id,
         edit_message=True,
         page=data.page,
+        after=data.after,
+        before=data.before,
     )
 
 
 @dp.callback_query(CallbackQueryFilter(callback_data=OpenCard))
-async def card_callback(callback_query: CallbackQuery, engine: Engine):
-    session = Session(engine)
-
+async def card_callback(callback_query: CallbackQuery, session: AsyncSession):
     if callback_query.message is None:
         return
 
@@ -301,19 +320,17 @@ async def card_callback(callback_query: CallbackQuery, engine: Engine):
 
 
 @dp.message(F.text.lower().strip() == "шанс")
-async def chance(message: Message, engine: Engine):
-    return await take_card(message, engine)
+async def chance(message: Message, session: AsyncSession):
+    return await take_card(message, session)
 
 
 @dp.message(F.text.lower().strip() == "шaнc" or F.text.lower().strip() == "шанc" or F.text.lower().strip() == "шaнс")
-async def chance(message: Message, engine: Engine):
+async def chance(message: Message, session: AsyncSession):
     return await message.reply("Нет иди нахуй")
 
 
 @dp.message(F.text.lower().strip() == "супершанс")
-async def super_chance(message: Message, engine: Engine):
-    session = Session(engine)
-
+async def super_chance(message: Message, session: AsyncSession):
     if message.forward_from or message.forward_from_chat or message.forward_sender_name:
         return
 
@@ -329,19 +346,17 @@ async def super_chance(message: Message, engine: Engine):
 
 
 @dp.message(F.text.lower().startwith("карточка "))
-async def card_short(message: Message, engine: Engine):
-    return await check_card(message, engine)
+async def card_short(message: Message, session: AsyncSession):
+    return await check_card(message, session)
 
 
 @dp.message(F.text.lower().startswith("коллекция"))
-async def collection_short(message: Message, engine: Engine):
-    return await check_collection(message, engine)
+async def collection_short(message: Message, session: AsyncSession):
+    return await check_collection(message, session)
 
 
 @dp.message(Command("render", "рендер", prefix="/!."))
-async def render_card(message: Message, engine: Engine):
-    session = Session(engine)
-
+async def render_card(message: Message, session: AsyncSession):
     # print(message.chat.id)
     if not await handle_chat(message.chat, True):
         return
@@ -362,7 +377,7 @@ async def render_card(message: Message, engine: Engine):
     if args[1].startswith("#"):
         base_color = args[1]
     else:
-        base_color = get_base_color(args[1])  # type: ignore
+        base_color = get_catalog().get_base_color(args[1])  # type: ignore
 
     background_type: Background = args[2]  # type: ignore
     rarity: Rarity = args[3]  # type: ignore
@@ -386,9 +401,7 @@ async def render_card(message: Message, engine: Engine):
 
 
 @dp.message(Command("del", "delete", "удалить", prefix="/!."))
-async def del_message(message: Message, engine: Engine):
-    session = Session(engine)
-
+async def del_message(message: Message, session: AsyncSession):
     if not await handle_chat(message.chat, True):
         return
 
@@ -414,10 +427,67 @@ async def del_message(message: Message, engine: Engine):
         logger.exception(exc)
 
 
-@dp.message(F.text)
-async def text_message(message: Message, engine: Engine):
-    session = Session(engine)
+@dp.message(Command("stats", "статистика", prefix="/!."))
+async def stats_message(message: Message, session: AsyncSession):
+    if not await handle_chat(message.chat, True):
+        return
+
+    from_user = message.from_user
+    if from_user is None:
+        return
+
+    if not await handle_user(session, from_user):
+        return
+
+    if from_user.id not in config["owner_id"]:
+        return await message.reply("Только владелец может использовать эту команду")
+
+    users = known_users.stats()
+    renders = render_cache.stats()
+    try:
+        assets = await worker_asset_stats()
+        asset_text = (
+            f"Ассеты одного воркера (из {RENDER_WORKERS}): "
+            f"{assets['static_layers']} статичных "
+            f"({assets['static_bytes'] / 1024**2:.1f} МБ), "
+            f"{assets['player_layers']} слоёв игроков "
+            f"({assets['player_bytes'] / 1024**2:.1f} МБ)\n"
+            f"Попадания: {assets['player_hits']}, промахи: {assets['player_misses']}"
+        )
+    except RenderQueueFull:
+        asset_text = "Ассеты воркеров: недоступно, очередь рендера заполнена"
+    await message.reply(
+        f"Пользователи в кэше: {users['size']}\n"
+        f"Попадания: {users['hits']}, промахи: {users['misses']} "
+        f"({users['hit_rate']:.1%})\n"
+        f"Рендеры в кэше: {renders['files']} "
+        f"({renders['bytes'] / 1024**2:.1f} МБ)\n"
+        f"Попадания: {renders['hits']}, промахи: {renders['misses']} "
+        f"({renders['hit_rate']:.1%})\n" + asset_text
+    )
 
+
+@dp.message(Command("recount", "пересчитать", prefix="/!."))
+async def recount_message(message: Message, session: AsyncSession):
+    if not await handle_chat(message.chat, True):
+        return
+
+    from_user = message.from_user
+    if from_user is None:
+        return
+
+    if not await handle_user(session, from_user):
+        return
+
+    if from_user.id not in config["owner_id"]:
+        return await message.reply("Только владелец может использовать эту команду")
+
+    users = await recount_user_cards(session)
+    await message.reply(f"Количество карточек пересчитано у {users} пользователей")
+
+
+@dp.message(F.text)
+async def text_message(message: Message, session: AsyncSession):
     if not await handle_chat(message.chat, True):
         return
 
@@ -436,32 +506,50 @@ async def error_handler(error: ErrorEvent):
 
 
 async def main():
-    # for i in range(100):
-    #     render_config = random_render_config()
-    #     render_config.number = i
-    #     print(render_config)
-    #     render(render_config).save(f"output/test/{i}.png")
-
-    # render_config = random_render_config()
-    # render_config.number = 1
-    # render(render_config).show()
-
-    if config["database_uri"].startswith("sqlite"):
-        connect_args: dict = {"check_same_thread": False}
-    else:
-        connect_args: dict = {}
-
-    engine: Engine = create_engine(
-        config["database_uri"],
-        connect_args=connect_args,
-        pool_size=config["pool_size"],
-        max_overflow=50,
+    engine: AsyncEngine = create_database_engine(
+        config["database_uri"], pool_size=config["pool_size"]
     )
 
-    SQLModel.metadata.create_all(engine)
+    await prepare_database(engine)
+    async with create_session(engine) as session:
+        await load_known_users(session)
 
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot, engine=engine)
+    render_cache.load()
+    # Hash the assets now rather than on the first render key.
+    await asyncio.to_thread(asset_fingerprint)
+    await start_executor()
+
+    dp.update.outer_middleware(DatabaseSessionMiddleware(engine))
+
+    metrics_runner = None
+    if METRICS_ENABLED:
+        for observer in (
+            dp.message,
+            dp.callback_query,
+            dp.chat_member,
+            dp.my_chat_member,
+        ):
+            observer.middleware(HandlerMetricsMiddleware())
+        bot.session.middleware(TelegramMetricsMiddleware())
+        metrics_runner = await start_metrics_server()
+
+    if config.get("prerender", False):
+        start_prerender(engine)
+
+    hot_reload_task = None
+    if HOT_RELOAD:
+        hot_reload_task = asyncio.create_task(watch_catalog())
+
+    try:
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(bot)
+    finally:
+        stop_prerender()
+        if hot_reload_task is not None:
+            hot_reload_task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        shutdown_executor()
 
 
 if __name__ == "__main__":
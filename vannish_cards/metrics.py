@@ -0,0 +1,156 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections.abc import Iterator
+
+from aiohttp import web
+from loguru import logger
+
+from .config import config
+
+# Every update method returns at once when disabled, so instrumented code
+# pays one attribute lookup and a call.
+METRICS_ENABLED: bool = config.get("metrics", False)
+METRICS_HOST: str = config.get("metrics_host", "127.0.0.1")
+METRICS_PORT: int = config.get("metrics_port", 9101)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric(ABC):
+    """Base of the metric types. Updated from the event loop thread only."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        registry.append(self)
+
+    @abstractmethod
+    def lines(self) -> Iterator[str]:
+        """Sample lines in the text exposition format."""
+
+    def render(self) -> str:
+        header = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        return "\n".join([*header, *self.lines()])
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        if not METRICS_ENABLED:
+            return
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def lines(self) -> Iterator[str]:
+        for labels, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+        # Per label set: one count per bucket and one for +Inf, not cumulative.
+        self.counts: dict[tuple[str, ...], list[int]] = {}
+        self.sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, value: float, *labels: str):
+        if not METRICS_ENABLED:
+            return
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+            self.sums[labels] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def lines(self) -> Iterator[str]:
+        names = (*self.labelnames, "le")
+        for labels, counts in self.counts.items():
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                total += count
+                le = bound if isinstance(bound, str) else repr(float(bound))
+                bucket_labels = format_labels(names, (*labels, le))
+                yield f"{self.name}_bucket{bucket_labels} {total}"
+            plain_labels = format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{plain_labels} {self.sums[labels]}"
+            yield f"{self.name}_count{plain_labels} {total}"
+
+
+registry: list[Metric] = []
+
+handler_seconds = Histogram(
+    "vannish_handler_seconds", "Time spent in a bot handler.", ("handler",)
+)
+render_stage_seconds = Histogram(
+    "vannish_render_stage_seconds",
+    "Time spent in a stage of rendering a card; queue is the wait for a worker.",
+    ("stage",),
+)
+render_queue_full_total = Counter(
+    "vannish_render_queue_full_total", "Renders refused because the queue was full."
+)
+db_query_seconds = Histogram(
+    "vannish_db_query_seconds", "Time spent in one database query."
+)
+update_db_queries = Histogram(
+    "vannish_update_db_queries",
+    "Database queries run while handling one update.",
+    buckets=COUNT_BUCKETS,
+)
+telegram_request_seconds = Histogram(
+    "vannish_telegram_request_seconds",
+    "Latency of a Telegram Bot API call.",
+    ("method",),
+)
+telegram_errors_total = Counter(
+    "vannish_telegram_errors_total", "Failed Telegram Bot API calls.", ("method",)
+)
+user_lock_wait_seconds = Histogram(
+    "vannish_user_lock_wait_seconds", "Time a card draw waited for the user's lock."
+)
+
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type="text/plain")
+
+
+async def start_metrics_server() -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"Metrics at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
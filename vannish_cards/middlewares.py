@@ -0,0 +1,98 @@
+from time import perf_counter
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import TelegramObject, Update
+from loguru import logger
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .database import QueryStats, create_session, query_stats
+from .metrics import (
+    handler_seconds,
+    telegram_errors_total,
+    telegram_request_seconds,
+    update_db_queries,
+)
+
+
+class DatabaseSessionMiddleware(BaseMiddleware):
+    """Open one session per update and pass it to handlers as `session`.
+
+    The session is committed when the handler returns, rolled back when it
+    raises, and closed either way.
+    """
+
+    def __init__(self, engine: AsyncEngine):
+        self.engine = engine
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        stats = QueryStats()
+        token = query_stats.set(stats)
+
+        try:
+            async with create_session(self.engine) as session:
+                data["session"] = session
+                try:
+                    result = await handler(event, data)
+                except BaseException:
+                    await session.rollback()
+                    raise
+                await session.commit()
+                return result
+        finally:
+            query_stats.reset(token)
+            update_db_queries.observe(stats.count)
+            if isinstance(event, Update):
+                logger.trace(
+                    f"Update {event.update_id}: {stats.count} queries "
+                    f"in {stats.seconds * 1000:.1f} ms"
+                )
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Time every handler the event reaches, labelled by its function name."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        start = perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            handler_seconds.observe(perf_counter() - start, name)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Time every Bot API call, labelled by the API method."""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        name = type(method).__name__
+        start = perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            telegram_errors_total.inc(name)
+            raise
+        finally:
+            telegram_request_seconds.observe(perf_counter() - start, name)
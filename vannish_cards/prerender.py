@@ -0,0 +1,188 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import suppress
+from time import perf_counter
+
+from loguru import logger
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from . import render_executor
+from .catalog import Catalog, get_catalog, set_catalog
+from .config import config
+from .database import count_cards, create_session, get_cards_page
+from .encoder import EncodedImage
+from .render import RenderConfig, warm_up
+from .render_cache import card_render_config, render_cache, render_key
+from .render_executor import ping, render_encoded
+
+# Bulk workers are forked from one helper process after it has warmed up,
+# so they share its single copy of the assets (about 1.45 GB) instead of
+# each loading their own. The helper is spawned, not forked from the bot,
+# whose event loop and database threads must not be copied.
+PRERENDER_WORKERS: int = config.get("prerender_workers", os.cpu_count() or 1)
+PRERENDER_BATCH_SIZE = 200
+# Cards sent to the helper at once; a few per worker keeps them all busy.
+PRERENDER_CHUNK_SIZE = PRERENDER_WORKERS * 4
+PRERENDER_LOG_INTERVAL = 30.0
+# Stop before the cache starts evicting what was just rendered.
+PRERENDER_CACHE_FILL = 0.9
+
+# The helper's own pool of forked workers; only set inside the helper.
+bulk_pool: ProcessPoolExecutor | None = None
+
+prerender_engine: AsyncEngine | None = None
+prerender_task: asyncio.Task | None = None
+
+
+def start_bulk_helper(catalog: Catalog, workers: int):
+    """Warm up once, then fork the bulk workers at the lowest priority, so
+    live draws get the CPU."""
+    global bulk_pool
+
+    os.nice(19)
+    set_catalog(catalog)
+    warm_up()
+    # A fork pool starts every worker now, before it starts any thread.
+    bulk_pool = ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("fork")
+    )
+    for future in [bulk_pool.submit(ping) for _ in range(workers)]:
+        future.result()
+
+
+def stop_bulk_helper():
+    # A process waits for its children before it exits, so the forked
+    # workers are stopped first.
+    if bulk_pool is not None:
+        bulk_pool.shutdown(cancel_futures=True)
+
+
+def render_bulk(render_configs: list[RenderConfig]) -> list[EncodedImage | None]:
+    """Render `render_configs` on the bulk workers; None where one failed."""
+    if bulk_pool is None:
+        raise RuntimeError("Bulk helper is not started")
+    futures = [bulk_pool.submit(render_encoded, c) for c in render_configs]
+    results: list[EncodedImage | None] = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as exc:
+            logger.exception(exc)
+            results.append(None)
+    return results
+
+
+def render_cache_full() -> bool:
+    return (
+        len(render_cache) >= render_cache.max_files * PRERENDER_CACHE_FILL
+        or render_cache.total_bytes >= render_cache.max_bytes * PRERENDER_CACHE_FILL
+    )
+
+
+async def prerender_cards(engine: AsyncEngine):
+    """Render every saved card that has no image for the current assets."""
+    async with create_session(engine) as session:
+        total = await count_cards(session)
+
+    loop = asyncio.get_running_loop()
+    # Created on the first card to render, so a warm cache costs no workers.
+    helper: ProcessPoolExecutor | None = None
+    checked = rendered = 0
+    start = last_log = perf_counter()
+
+    async def render_chunk(chunk: list[tuple[str, RenderConfig]]):
+        nonlocal rendered
+        # Live renders go first; bulk work waits until they are done.
+        while render_executor.pending_renders > 0:
+            await asyncio.sleep(0.1)
+        results = await loop.run_in_executor(
+            helper, render_bulk, [render_config for _, render_config in chunk]
+        )
+        for (key, _), encoded in zip(chunk, results):
+            if encoded is not None:
+                await render_cache.put(key, encoded.data)
+                rendered += 1
+
+    logger.info(f"Pre-render started: {total} cards, {PRERENDER_WORKERS} workers")
+    try:
+        after = None
+        while not render_cache_full():
+            async with create_session(engine) as session:
+                cards = await get_cards_page(session, PRERENDER_BATCH_SIZE, after)
+            if not cards:
+                break
+            after = cards[-1].number
+
+            chunk: list[tuple[str, RenderConfig]] = []
+            for card in cards:
+                checked += 1
+                render_config = card_render_config(card)
+                key = render_key(render_config)
+                if key not in render_cache:
+                    chunk.append((key, render_config))
+            if not chunk:
+                continue
+
+            if helper is None:
+                helper = ProcessPoolExecutor(
+                    1,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=start_bulk_helper,
+                    initargs=(get_catalog(), PRERENDER_WORKERS),
+                )
+                await loop.run_in_executor(helper, ping)
+                if not rendered:
+                    start = last_log = perf_counter()
+
+            for i in range(0, len(chunk), PRERENDER_CHUNK_SIZE):
+                await render_chunk(chunk[i : i + PRERENDER_CHUNK_SIZE])
+
+            if perf_counter() - last_log >= PRERENDER_LOG_INTERVAL:
+                last_log = perf_counter()
+                logger.info(
+                    f"Pre-render: {checked}/{total} cards checked, "
+                    f"{rendered} rendered, "
+                    f"{rendered / (last_log - start):.2f} cards/s"
+                )
+    finally:
+        if helper is not None:
+            # Queued behind the chunk being rendered, if any. A broken
+            # helper took its workers with it.
+            with suppress(BrokenProcessPool):
+                helper.submit(stop_bulk_helper)
+            helper.shutdown(wait=False)
+
+    if render_cache_full():
+        logger.warning(
+            "Pre-render stopped: render cache is full, raise "
+            "render_cache_max_files or render_cache_max_bytes"
+        )
+    elapsed = perf_counter() - start
+    logger.info(
+        f"Pre-render finished: {checked}/{total} cards checked, "
+        f"{rendered} rendered in {elapsed:.1f} s "
+        f"({rendered / elapsed:.2f} cards/s)"
+    )
+
+
+def start_prerender(engine: AsyncEngine):
+    """Pre-render in the background, cancelling a run still going."""
+    global prerender_engine, prerender_task
+
+    prerender_engine = engine
+    stop_prerender()
+    prerender_task = asyncio.create_task(prerender_cards(engine))
+
+
+def restart_prerender():
+    """Start over after the render keys changed, if pre-rendering is on."""
+    if prerender_engine is not None:
+        start_prerender(prerender_engine)
+
+
+def stop_prerender():
+    if prerender_task is not None:
+        prerender_task.cancel()
@@ -1,42 +1,122 @@
 import random
-from typing import TypeVar
+from bisect import bisect
+from collections.abc import Hashable
+from itertools import accumulate
+from typing import Generic, TypeVar
 
-from .config import get_base_color, index
+from .catalog import Catalog, get_catalog
 from .data_types import Background, BaseColor, PlayerRarity, Rarity
 from .render import RenderConfig
 
-KT = TypeVar("KT")
+KT = TypeVar("KT", bound=Hashable)
 
+# Shared by draws that are not given their own generator.
+default_rng = random.Random()
 
-def choose_variant_with_probability(options: dict[KT, int]) -> KT:
-    return random.choices(
-        population=list(options.keys()), weights=list(options.values()), k=1
-    )[0]
 
+class Distribution(Generic[KT]):
+    """Weighted choice over fixed options, with the cumulative weights built
+    once instead of on every draw."""
 
-def random_render_config() -> RenderConfig:
-    total_players = []
+    def __init__(self, options: dict[KT, int]):
+        self.population: list[KT] = list(options)
+        self.cum_weights: list[int] = list(accumulate(options.values()))
+        self.total = self.cum_weights[-1]
 
-    # for _, player_nicknames in index["players"].items():
-    #     total_players.extend(player_nicknames)
+    def choose(self, rng: random.Random = default_rng) -> KT:
+        return self.population[bisect(self.cum_weights, rng.random() * self.total)]
 
-    base_colors: dict[BaseColor, int] = index["chances"]["base_colors"]
-    player_rarities: dict[PlayerRarity, int] = index["chances"]["players"]
-    backgrounds: dict[Background, int] = index["chances"]["backgrounds"]
-    rarities: dict[Rarity, int] = index["chances"]["rarities"]
+    def choose_many(self, n: int, rng: random.Random = default_rng) -> list[KT]:
+        return rng.choices(self.population, cum_weights=self.cum_weights, k=n)
 
-    base_color_name: BaseColor = choose_variant_with_probability(base_colors)
-    base_color: str = get_base_color(base_color_name)
-    player_rarity: PlayerRarity = choose_variant_with_probability(player_rarities)
-    background: Background = choose_variant_with_probability(backgrounds)
-    rarity: Rarity = choose_variant_with_probability(rarities)
-    # player: str = random.choice(total_players)
-    player: str = random.choice(index["players"][player_rarity])
+    def probability(self, option: KT) -> float:
+        i = self.population.index(option)
+        previous = self.cum_weights[i - 1] if i else 0
+        return (self.cum_weights[i] - previous) / self.total
 
-    return RenderConfig(
-        base_color=base_color,
-        background_type=background,
-        rarity=rarity,
-        nickname=player,
-        number=None,
-    )
+
+class CardChances:
+    """The chances tables of a catalog, compiled for drawing cards."""
+
+    def __init__(self, catalog: Catalog):
+        self.catalog = catalog
+        chances = catalog.index["chances"]
+        self.base_colors: Distribution[BaseColor] = Distribution(chances["base_colors"])
+        self.player_rarities: Distribution[PlayerRarity] = Distribution(
+            chances["players"]
+        )
+        self.backgrounds: Distribution[Background] = Distribution(
+            chances["backgrounds"]
+        )
+        self.rarities: Distribution[Rarity] = Distribution(chances["rarities"])
+        self.base_color_hex: dict[BaseColor, str] = {
+            name: catalog.get_base_color(name) for name in self.base_colors.population
+        }
+        self.players: dict[PlayerRarity, list[str]] = {
+            player_rarity: list(catalog.players[player_rarity])
+            for player_rarity in self.player_rarities.population
+        }
+
+    def draw(self, rng: random.Random = default_rng) -> RenderConfig:
+        player_rarity = self.player_rarities.choose(rng)
+        return RenderConfig(
+            base_color=self.base_color_hex[self.base_colors.choose(rng)],
+            background_type=self.backgrounds.choose(rng),
+            rarity=self.rarities.choose(rng),
+            nickname=rng.choice(self.players[player_rarity]),
+            number=None,
+        )
+
+    def draw_columns(
+        self, n: int, rng: random.Random = default_rng
+    ) -> tuple[list[BaseColor], list[Background], list[Rarity], list[str]]:
+        """Draw `n` cards as one list per attribute."""
+        base_colors = self.base_colors.choose_many(n, rng)
+        backgrounds = self.backgrounds.choose_many(n, rng)
+        rarities = self.rarities.choose_many(n, rng)
+        players = self.players
+        nicknames = [
+            rng.choice(players[player_rarity])
+            for player_rarity in self.player_rarities.choose_many(n, rng)
+        ]
+        return base_colors, backgrounds, rarities, nicknames
+
+
+chances = CardChances(get_catalog())
+
+
+def get_chances() -> CardChances:
+    """Chances of the current catalog, recompiled after it is reloaded."""
+    global chances
+
+    catalog = get_catalog()
+    if chances.catalog is not catalog:
+        chances = CardChances(catalog)
+    return chances
+
+
+def random_render_config(rng: random.Random = default_rng) -> RenderConfig:
+    return get_chances().draw(rng)
+
+
+def random_render_configs(
+    n: int, rng: random.Random = default_rng
+) -> list[RenderConfig]:
+    """Draw `n` cards at once, e.g. for simulations and bulk renders.
+
+    Pass `random.Random(seed)` as `rng` to get the same cards on every run.
+    """
+    chances = get_chances()
+    base_color_hex = chances.base_color_hex
+    return [
+        RenderConfig(
+            base_color=base_color_hex[base_color],
+            background_type=background,
+            rarity=rarity,
+            nickname=nickname,
+            number=None,
+        )
+        for base_color, background, rarity, nickname in zip(
+            *chances.draw_columns(n, rng)
+        )
+    ]
@@ -1,11 +1,22 @@
 from dataclasses import dataclass
-from typing import Iterable
+from functools import lru_cache
+from time import perf_counter
 
-from PIL import Image, ImageColor, ImageDraw
+from loguru import logger
+from PIL import Image, ImageColor, ImageDraw, ImageMath
 from PIL.Image import Image as ImageType
 
-from .cache import number_font
-from .config import HEIGHT, WIDTH
+from .cache import (
+    PRESCALE_ASSETS,
+    Layer,
+    LRUCache,
+    forget_layers,
+    get_layer,
+    number_font,
+)
+from .cache import warm_up as warm_up_assets
+from .catalog import get_catalog
+from .config import ASSET_HEIGHT, ASSET_WIDTH, HEIGHT, WIDTH, config
 from .data_types import Background, Rarity, RgbColor, RgbOrRgbaColor
 
 
@@ -26,82 +37,256 @@ class RenderConfig:
 #         config.base_color = (base_color[0], base_color[1], base_color[2])
 
 
-def apply_color(img: ImageType, new_color: RgbOrRgbaColor) -> ImageType:
-    modified_img = Image.new("RGBA", img.size, (0, 0, 0, 0))
+# Sum of the RGB channels of a transparent pixel is shifted past the last
+# possible sum (3 * 255), so the lookup tables map it to a zeroed pixel.
+TRANSPARENT_OFFSET = 766
+
 
-    pixels: Iterable[Iterable[RgbOrRgbaColor]] | None = img.load()
-    new_pixels: Iterable[Iterable[RgbOrRgbaColor]] | None = modified_img.load()
+@lru_cache(maxsize=64)
+def recolor_luts(new_color: RgbColor) -> tuple[list[int], list[int], list[int]]:
+    luts = []
+    for channel in new_color:
+        lut = [
+            int((channel / 255) * ((channel_sum / 3) / 255) * 255)
+            for channel_sum in range(TRANSPARENT_OFFSET)
+        ]
+        lut.extend([0] * (65536 - TRANSPARENT_OFFSET))
+        luts.append(lut)
+    return luts[0], luts[1], luts[2]
 
-    if pixels is None or new_pixels is None:
+
+def apply_color(img: ImageType, new_color: RgbOrRgbaColor) -> ImageType:
+    if img.mode != "RGBA":
         raise ValueError("Incorrect image format")
 
-    for x in range(img.width):
-        for y in range(img.height):
-            pixel = pixels[x, y]
+    r, g, b, a = img.split()
+
+    channel_sum = ImageMath.lambda_eval(
+        lambda args: (
+            args["r"] + args["g"] + args["b"] + (args["a"] < 1) * TRANSPARENT_OFFSET
+        ),
+        r=r,
+        g=g,
+        b=b,
+        a=a,
+    )
+
+    r_lut, g_lut, b_lut = recolor_luts((new_color[0], new_color[1], new_color[2]))
+
+    return Image.merge(
+        "RGBA",
+        (
+            channel_sum.point(r_lut, "L"),
+            channel_sum.point(g_lut, "L"),
+            channel_sum.point(b_lut, "L"),
+            a,
+        ),
+    )
+
+
+def palette_colors() -> list[RgbColor]:
+    colors = []
+    for base_color_hex in get_catalog().base_color_hex.values():
+        rgb = ImageColor.getrgb(base_color_hex)
+        colors.append((rgb[0], rgb[1], rgb[2]))
+    return colors
+
+
+def background_layer_paths() -> list[str]:
+    return list(get_catalog().background_paths.values())
+
+
+# Palette colors are prepared once and kept; arbitrary `/render` colors
+# go through LRUs bounded by `recolor_cache_size`.
+palette_frames: dict[RgbColor, ImageType] = {}
+custom_frames: LRUCache[RgbColor, ImageType] = LRUCache(
+    config.get("recolor_cache_size", 16)
+)
+palette_recolored_layers: dict[tuple[str, RgbColor], Layer] = {}
+custom_recolored_layers: LRUCache[tuple[str, RgbColor], Layer] = LRUCache(
+    config.get("recolor_cache_size", 16)
+)
+
+
+def recolor_layer(layer: Layer, new_color: RgbColor) -> Layer:
+    return Layer.from_image(
+        apply_color(layer.image, new_color), offset=layer.offset, size=layer.size
+    )
+
+
+def get_recolored_layer(path: str, new_color: RgbOrRgbaColor) -> Layer:
+    key = (path, (new_color[0], new_color[1], new_color[2]))
+
+    layer = palette_recolored_layers.get(key)
+    if layer is not None:
+        return layer
+
+    layer = custom_recolored_layers.get(key)
+    if layer is None:
+        layer = recolor_layer(get_layer(path), key[1])
+        custom_recolored_layers.put(key, layer)
+    return layer
+
+
+def paste_layer(img: ImageType, layer: Layer):
+    img.paste(layer.rgb, layer.offset, layer.mask)
+
 
-            if pixel[3] <= 0:
-                continue
+def make_frame(new_color: RgbColor) -> ImageType:
+    """Recolored outline with the center pasted over it.
 
-            brightness = sum(pixel[:3]) / 3
+    Both sit under the skin and depend only on the base color, so this
+    part of the card is composited once per color and copied per render.
+    """
+    outline = recolor_layer(get_layer("assets/outline.png"), new_color)
+    center = get_layer("assets/center.png")
 
-            r = int((new_color[0] / 255) * (brightness / 255) * 255)
-            g = int((new_color[1] / 255) * (brightness / 255) * 255)
-            b = int((new_color[2] / 255) * (brightness / 255) * 255)
+    img = Image.new("RGBA", outline.size, (0, 0, 0, 0))
+    paste_layer(img, outline)
+    paste_layer(img, center)
+    return img
 
-            new_pixels[x, y] = (r, g, b, pixel[3])
 
-    return modified_img
+def get_frame(new_color: RgbOrRgbaColor) -> ImageType:
+    key = (new_color[0], new_color[1], new_color[2])
 
+    frame = palette_frames.get(key)
+    if frame is not None:
+        return frame
 
-def render(config: RenderConfig) -> ImageType:
-    """v1.0.2"""
+    frame = custom_frames.get(key)
+    if frame is None:
+        frame = make_frame(key)
+        custom_frames.put(key, frame)
+    return frame
+
+
+def draw_number(img: ImageType, number: int):
+    number_text = f"#{number}"
+    left, top, right, bottom = number_font.getbbox(number_text)
+
+    x, y = 695, 310
+    if PRESCALE_ASSETS:
+        x, y = round(x * WIDTH / ASSET_WIDTH), round(y * HEIGHT / ASSET_HEIGHT)
+
+    # Only the text's bounding box is drawn and pasted, not a full-size canvas.
+    num_img = Image.new("RGBA", (right - left, bottom - top), (0, 0, 0, 0))
+    num_draw = ImageDraw.Draw(num_img)
+    num_draw.text(
+        (-left, -top),
+        number_text,
+        fill=(255, 255, 255, 150),
+        align="center",
+        font=number_font,
+    )
+
+    img.paste(num_img.convert("RGB"), (x + left, y + top), num_img)
+
+
+def warm_up():
+    warm_up_assets()
+
+    for color in palette_colors():
+        if color not in palette_frames:
+            palette_frames[color] = make_frame(color)
+        for path in background_layer_paths():
+            if (path, color) not in palette_recolored_layers:
+                palette_recolored_layers[(path, color)] = recolor_layer(
+                    get_layer(path), color
+                )
+
+    logger.info(
+        f"Recolored layers prepared: "
+        f"{len(palette_frames)} frames, {len(palette_recolored_layers)} backgrounds"
+    )
+
+
+def forget_assets(paths: set[str]):
+    """Drop what was cached from the changed asset files; the next render
+    that needs them reads the new files.
+
+    Renders running meanwhile see either the old or the new entries.
+    """
+    forget_layers(paths)
+    if paths & {"assets/outline.png", "assets/center.png"}:
+        palette_frames.clear()
+        custom_frames.clear()
+
+    for key in list(palette_recolored_layers):
+        if key[0] in paths:
+            palette_recolored_layers.pop(key, None)
+    for key in custom_recolored_layers.keys():
+        if key[0] in paths:
+            custom_recolored_layers.pop(key)
+
+
+def refresh_assets():
+    """Drop what was cached for colors no longer in the palette, then
+    prepare what the current catalog needs."""
+    colors = set(palette_colors())
+    for color in list(palette_frames):
+        if color not in colors:
+            palette_frames.pop(color, None)
+    for key in list(palette_recolored_layers):
+        if key[1] not in colors:
+            palette_recolored_layers.pop(key, None)
+
+    warm_up()
+
+
+def lap(timings: dict[str, float] | None, stage: str, start: float) -> float:
+    """Record the time since `start` as `stage`; return the current time."""
+    now = perf_counter()
+    if timings is not None:
+        timings[stage] = now - start
+    return now
+
+
+def render(config: RenderConfig, timings: dict[str, float] | None = None) -> ImageType:
+    """v1.0.2
+
+    Stage durations in seconds are written to `timings` when it is given.
+    """
 
     # prepare_config(config)
 
+    start = perf_counter()
     if isinstance(config.base_color, str):
         base_color: RgbOrRgbaColor = ImageColor.getrgb(config.base_color)
     else:
         base_color: RgbOrRgbaColor = config.base_color
 
-    outline = Image.open("assets/outline.png").convert("RGBA")
-    outline = apply_color(outline, base_color)
-    center = Image.open("assets/center.png").convert("RGBA")
-    base = Image.open("assets/base.png").convert("RGBA")
-    background = Image.open(f"assets/background/{config.background_type}.png").convert(
-        "RGBA"
+    frame = get_frame(base_color)
+    base = get_layer("assets/base.png")
+    background = get_recolored_layer(
+        f"assets/background/{config.background_type}.png", base_color
     )
-    background = apply_color(background, base_color)
-    skin = Image.open(f"assets/skin/{config.nickname}.png").convert("RGBA")
-    nickname = Image.open(f"assets/nickname/{config.nickname}.png").convert("RGBA")
-    rarity = Image.open(f"assets/rarity/{config.rarity}.png").convert("RGBA")
+    skin = get_layer(f"assets/skin/{config.nickname}.png")
+    nickname = get_layer(f"assets/nickname/{config.nickname}.png")
+    rarity = get_layer(f"assets/rarity/{config.rarity}.png")
+    start = lap(timings, "layers", start)
 
-    img = Image.new("RGBA", base.size, (0, 0, 0, 0))
+    img = frame.copy()
 
-    img.paste(outline.convert("RGB"), (0, 0), outline.convert("RGBA"))
-    img.paste(center.convert("RGB"), (0, 0), center.convert("RGBA"))
-    img.paste(skin.convert("RGB"), (0, 0), skin.convert("RGBA"))
-    img.paste(base.convert("RGB"), (0, 0), base.convert("RGBA"))
-    img.paste(background.convert("RGB"), (0, 0), background.convert("RGBA"))
-    img.paste(nickname.convert("RGB"), (0, 0), nickname.convert("RGBA"))
-    img.paste(rarity.convert("RGB"), (0, 0), rarity.convert("RGBA"))
+    paste_layer(img, skin)
+    paste_layer(img, base)
+    paste_layer(img, background)
+    paste_layer(img, nickname)
+    paste_layer(img, rarity)
+    start = lap(timings, "paste", start)
 
     if config.number is not None:
-        num_img = Image.new("RGBA", base.size, (0, 0, 0, 0))
-        num_draw = ImageDraw.Draw(num_img)
-        num_draw.text(
-            (695, 310),
-            f"#{config.number}",
-            fill=(255, 255, 255, 150),
-            align="center",
-            font=number_font,
-        )
-
-        img.paste(num_img.convert("RGB"), (0, 0), num_img.convert("RGBA"))
+        draw_number(img, config.number)
+    start = lap(timings, "number", start)
 
-    return adjust_resolution(img)
+    img = adjust_resolution(img)
+    lap(timings, "resize", start)
+    return img
 
 
 def adjust_resolution(img: ImageType) -> ImageType:
+    if img.size == (WIDTH, HEIGHT):
+        return img
     return img.resize((WIDTH, HEIGHT))
 
 
@@ -0,0 +1,147 @@
+"""Render cards offline, e.g. to regenerate a collection or size hardware.
+
+python -m vannish_cards.render_batch --count 100
+python -m vannish_cards.render_batch --all --workers 8 --output output/all
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import resource
+import statistics
+import sys
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from time import perf_counter
+
+from loguru import logger
+
+from .config import config
+from .database import create_database_engine, create_session, get_cards_page
+from .encoder import encode, encoder_config
+from .randomizer import random_render_configs
+from .render import RenderConfig, render, warm_up
+from .render_cache import card_render_config
+from .render_executor import ping
+
+BATCH_PAGE_SIZE = 1000
+
+
+def render_to_file(render_config: RenderConfig, path: str) -> float:
+    start = perf_counter()
+    encoded = encode(render(render_config))
+    with open(path, "wb") as f:
+        f.write(encoded.data)
+    return perf_counter() - start
+
+
+def random_jobs(count: int, seed: int | None) -> list[tuple[str, RenderConfig]]:
+    jobs = []
+    # Card numbers start at 1, like the ones the bot hands out.
+    for i, render_config in enumerate(
+        random_render_configs(count, random.Random(seed)), start=1
+    ):
+        render_config.number = i
+        jobs.append((f"random-{i}", render_config))
+    return jobs
+
+
+async def card_jobs(database_uri: str) -> list[tuple[str, RenderConfig]]:
+    engine = create_database_engine(database_uri, pool_size=1)
+    jobs = []
+    after = None
+    try:
+        while True:
+            async with create_session(engine) as session:
+                cards = await get_cards_page(session, BATCH_PAGE_SIZE, after)
+            if not cards:
+                break
+            after = cards[-1].number
+            jobs.extend((str(card.number), card_render_config(card)) for card in cards)
+    finally:
+        await engine.dispose()
+    return jobs
+
+
+def create_pool(workers: int) -> ProcessPoolExecutor:
+    if "fork" in multiprocessing.get_all_start_methods():
+        # Forked workers share the warm caches of this process until written.
+        warm_up()
+        return ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("fork")
+        )
+    return ProcessPoolExecutor(workers, initializer=warm_up)
+
+
+def peak_rss_mb(who: int) -> float:
+    peak = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m vannish_cards.render_batch",
+        description="Render cards offline and report throughput.",
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--count", type=int, help="render N random cards")
+    source.add_argument("--all", action="store_true", help="render every saved card")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="render processes"
+    )
+    parser.add_argument("--output", default="output/batch", help="output directory")
+    parser.add_argument("--seed", type=int, help="seed for the random cards")
+    args = parser.parse_args()
+
+    if args.all:
+        jobs = asyncio.run(card_jobs(config["database_uri"]))
+    else:
+        jobs = random_jobs(args.count, args.seed)
+    os.makedirs(args.output, exist_ok=True)
+
+    executor = create_pool(args.workers)
+    for future in [executor.submit(ping) for _ in range(args.workers)]:
+        future.result()
+
+    logger.info(f"Rendering {len(jobs)} cards with {args.workers} workers")
+    latencies: list[float] = []
+    pending: set[Future[float]] = set()
+    start = perf_counter()
+
+    def collect(done: set[Future[float]]):
+        latencies.extend(future.result() for future in done)
+        if len(latencies) // 100 != (len(latencies) - len(done)) // 100:
+            logger.info(f"{len(latencies)}/{len(jobs)} cards rendered")
+
+    for name, render_config in jobs:
+        # Keep every worker busy without queueing the whole batch at once.
+        if len(pending) >= args.workers * 2:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+        path = os.path.join(args.output, f"{name}.{encoder_config.extension}")
+        pending.add(executor.submit(render_to_file, render_config, path))
+    done, _ = wait(pending)
+    collect(done)
+
+    elapsed = perf_counter() - start
+    executor.shutdown()
+
+    print(f"Rendered {len(latencies)} cards in {elapsed:.1f} s")
+    print(f"Throughput: {len(latencies) / elapsed:.2f} cards/s")
+    if len(latencies) >= 2:
+        percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+        print(
+            f"Latency per card: p50 {percentiles[49] * 1000:.0f} ms, "
+            f"p99 {percentiles[98] * 1000:.0f} ms"
+        )
+    # Worker RSS includes the pages it still shares with the main process.
+    print(
+        f"Peak RSS: main {peak_rss_mb(resource.RUSAGE_SELF):.0f} MB, "
+        f"largest worker {peak_rss_mb(resource.RUSAGE_CHILDREN):.0f} MB"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from dataclasses import astuple
+from uuid import uuid4
+
+from loguru import logger
+
+from .cache import PRESCALE_ASSETS
+from .catalog import get_catalog
+from .config import HEIGHT, WIDTH, config
+from .database import SavedCard
+from .encoder import EncoderConfig, encoder_config
+from .render import RenderConfig
+from .render_executor import render_async
+
+RENDER_CACHE_DIR: str = config.get("render_cache_dir", "output/renders")
+RENDER_CACHE_MAX_BYTES: int = config.get("render_cache_max_bytes", 2 * 1024**3)
+RENDER_CACHE_MAX_FILES: int = config.get("render_cache_max_files", 20000)
+
+
+def hash_assets() -> str:
+    """Hash of everything besides the card itself that changes its pixels.
+
+    Reads every asset file; call it off the event loop.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{WIDTH}x{HEIGHT}:{PRESCALE_ASSETS}".encode())
+    for root, dirs, files in os.walk("assets"):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(path.encode())
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+current_fingerprint: str | None = None
+
+
+def asset_fingerprint() -> str:
+    """The `hash_assets()` render keys are built from, computed on first use."""
+    global current_fingerprint
+
+    if current_fingerprint is None:
+        current_fingerprint = hash_assets()
+    return current_fingerprint
+
+
+def set_asset_fingerprint(fingerprint: str):
+    """Make `fingerprint`, hashed ahead with `hash_assets()`, current."""
+    global current_fingerprint
+
+    current_fingerprint = fingerprint
+
+
+def card_render_config(card: SavedCard) -> RenderConfig:
+    return RenderConfig(
+        base_color=get_catalog().get_base_color(card.base_color.value),
+        background_type=card.background.value,
+        rarity=card.rarity.value,
+        nickname=card.nickname,
+        number=card.number,
+    )
+
+
+def render_key(
+    render_config: RenderConfig, encoder: EncoderConfig = encoder_config
+) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(asset_fingerprint().encode())
+    digest.update(repr(astuple(render_config)).encode())
+    digest.update(repr(astuple(encoder)).encode())
+    return digest.hexdigest()
+
+
+def write_file(path: str, data: bytes):
+    """Write `path` under a temporary name first, so readers never see a
+    partial file."""
+    temp_path = f"{path}.{uuid4().hex}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+class RenderCache:
+    """Encoded cards on disk, named by render key and evicted least recently
+    used first once `max_bytes` or `max_files` is exceeded.
+
+    Only used from the event loop thread.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_files: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.extension = encoder_config.extension
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+        self._sizes: OrderedDict[str, int] = OrderedDict()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.{self.extension}")
+
+    def load(self):
+        """Index the files already on disk, oldest access first."""
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                # Left behind by a write that never finished.
+                os.remove(entry.path)
+                continue
+            key, _, extension = entry.name.partition(".")
+            if extension != self.extension or not entry.is_file():
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, key, stat.st_size))
+
+        self._sizes.clear()
+        for _, key, size in sorted(entries):
+            self._sizes[key] = size
+        self.total_bytes = sum(self._sizes.values())
+        self.evict()
+        logger.info(f"Render cache loaded: {self.stats()}")
+
+    def get(self, key: str) -> str | None:
+        if key not in self._sizes:
+            self.misses += 1
+            return None
+
+        path = self.path(key)
+        try:
+            # mtime keeps the access order across restarts.
+            os.utime(path)
+        except FileNotFoundError:
+            self.total_bytes -= self._sizes.pop(key)
+            self.misses += 1
+            return None
+        self._sizes.move_to_end(key)
+        self.hits += 1
+        return path
+
+    async def put(self, key: str, data: bytes) -> str:
+        path = self.path(key)
+        # The file is written off the loop; only the index is updated here.
+        await asyncio.to_thread(write_file, path, data)
+
+        self.total_bytes += len(data) - self._sizes.get(key, 0)
+        self._sizes[key] = len(data)
+        self._sizes.move_to_end(key)
+        self.evict()
+        return path
+
+    def evict(self):
+        while len(self._sizes) > 1 and (
+            self.total_bytes > self.max_bytes or len(self._sizes) > self.max_files
+        ):
+            key, size = self._sizes.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "files": len(self._sizes),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._sizes
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+
+render_cache = RenderCache(
+    RENDER_CACHE_DIR, RENDER_CACHE_MAX_BYTES, RENDER_CACHE_MAX_FILES
+)
+
+
+async def render_cached(render_config: RenderConfig, reserved: bool = False) -> str:
+    """Return the path of the encoded card, rendering it on a cache miss.
+
+    `reserved` is passed on to `render_async`.
+    """
+    key = render_key(render_config)
+    path = render_cache.get(key)
+    if path is None:
+        encoded = await render_async(render_config, reserved)
+        path = await render_cache.put(key, encoded.data)
+    return path
@@ -0,0 +1,191 @@
+import asyncio
+from collections.abc import Callable, Iterator
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+
+from loguru import logger
+
+from .cache import asset_stats
+from .catalog import Catalog, get_catalog, set_catalog
+from .config import config
+from .encoder import EncodedImage, encode
+from .metrics import METRICS_ENABLED, render_queue_full_total, render_stage_seconds
+from .render import RenderConfig, forget_assets, refresh_assets, render, warm_up
+
+RENDER_WORKERS: int = config.get("render_workers", 1)
+RENDER_QUEUE_SIZE: int = config.get("render_queue_size", 8)
+
+
+class RenderQueueFull(Exception):
+    """Raised when `render_queue_size` renders are already in flight."""
+
+
+def render_encoded(render_config: RenderConfig) -> EncodedImage:
+    return encode(render(render_config))
+
+
+def render_encoded_timed(
+    render_config: RenderConfig,
+) -> tuple[EncodedImage, dict[str, float]]:
+    timings: dict[str, float] = {}
+    encoded = encode(render(render_config, timings))
+    timings["encode"] = encoded.seconds
+    return encoded, timings
+
+
+def ping():
+    return None
+
+
+def start_render_worker(catalog: Catalog):
+    """Process pool initializer; `catalog` may be newer than the one the
+    worker inherited, as pools are built before a reload is applied."""
+    set_catalog(catalog)
+    warm_up()
+
+
+executor: Executor | None = None
+pending_renders = 0
+
+
+async def create_executor(catalog: Catalog) -> Executor:
+    """Create a render pool and wait until every worker has its assets.
+
+    Process workers render with `catalog` and warm their own caches up in
+    the initializer; thread workers share the catalog and caches of this
+    process, so those are warmed here.
+    """
+    if config.get("render_executor", "process") == "thread":
+        await asyncio.to_thread(warm_up)
+        new_executor: Executor = ThreadPoolExecutor(
+            max_workers=RENDER_WORKERS, thread_name_prefix="render"
+        )
+    else:
+        new_executor = ProcessPoolExecutor(
+            max_workers=RENDER_WORKERS,
+            initializer=start_render_worker,
+            initargs=(catalog,),
+        )
+
+    loop = asyncio.get_running_loop()
+    try:
+        await asyncio.gather(
+            *(loop.run_in_executor(new_executor, ping) for _ in range(RENDER_WORKERS))
+        )
+    except BaseException:
+        new_executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    return new_executor
+
+
+async def start_executor():
+    global executor
+
+    executor = await create_executor(get_catalog())
+    logger.info(f"Render executor ready: {RENDER_WORKERS} workers")
+
+
+async def reload_executor(
+    catalog: Catalog, changed_assets: set[str], switch: Callable[[], None]
+):
+    """Make renders use `catalog` and the current asset files.
+
+    `switch` makes `catalog` current, and with it the render keys. It runs
+    only once the old images can no longer be rendered, so a new key never
+    gets an old image.
+
+    Thread workers share this process's caches, which drop only what
+    changed. Process workers cannot be reached one by one, so a new pool is
+    warmed up while the old one keeps serving, then replaces it.
+    """
+    global executor
+
+    if isinstance(executor, ThreadPoolExecutor):
+        await asyncio.to_thread(forget_assets, changed_assets)
+        switch()
+        await asyncio.to_thread(refresh_assets)
+        return
+
+    new_executor = await create_executor(catalog)
+    old_executor, executor = executor, new_executor
+    switch()
+    if old_executor is not None:
+        # Renders already submitted finish on the old workers; their keys
+        # were taken before the switch.
+        old_executor.shutdown(wait=False)
+    logger.info(f"Render executor restarted: {RENDER_WORKERS} workers")
+
+
+def shutdown_executor():
+    global executor
+
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor = None
+
+
+async def worker_asset_stats() -> dict[str, int]:
+    """Asset cache stats of one render worker; process workers each hold a
+    copy of the same assets, so any one of them is representative.
+
+    Queued like a render, so raises RenderQueueFull when the queue is.
+    """
+    if executor is None:
+        raise RuntimeError("Render executor is not started")
+    with render_slot():
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, asset_stats)
+
+
+@contextmanager
+def render_slot() -> Iterator[None]:
+    """Hold one of the `render_queue_size` places in the render queue.
+
+    Raises RenderQueueFull when none is free. Taking the slot before work
+    that cannot be undone (such as allocating a card number) guarantees
+    the render that follows is not rejected.
+    """
+    global pending_renders
+
+    if pending_renders >= RENDER_QUEUE_SIZE:
+        render_queue_full_total.inc()
+        raise RenderQueueFull()
+
+    pending_renders += 1
+    try:
+        yield
+    finally:
+        pending_renders -= 1
+
+
+async def render_async(
+    render_config: RenderConfig, reserved: bool = False
+) -> EncodedImage:
+    """Render and encode a card off the event loop.
+
+    `reserved` means the caller already holds a `render_slot()`.
+    """
+    if executor is None:
+        raise RuntimeError("Render executor is not started")
+
+    with nullcontext() if reserved else render_slot():
+        loop = asyncio.get_running_loop()
+        if METRICS_ENABLED:
+            start = perf_counter()
+            encoded, timings = await loop.run_in_executor(
+                executor, render_encoded_timed, render_config
+            )
+            timings["queue"] = perf_counter() - start - sum(timings.values())
+            for stage, seconds in timings.items():
+                render_stage_seconds.observe(seconds, stage)
+        else:
+            encoded = await loop.run_in_executor(
+                executor, render_encoded, render_config
+            )
+
+    logger.debug(
+        f"Card encoded: {encoded.format}, {encoded.size} bytes "
+        f"in {encoded.seconds * 1000:.1f} ms"
+    )
+    return encoded
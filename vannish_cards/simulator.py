@@ -0,0 +1,319 @@
+"""Draw many cards with the randomizer and check the drop rates it produces
+against the chances in an index.
+
+python -m vannish_cards.simulator --draws 10000000
+python -m vannish_cards.simulator --index new_index.json --seed 1
+python -m vannish_cards.simulator --combinations 50
+"""
+
+import argparse
+import heapq
+import os
+import random
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from math import prod, sqrt
+from statistics import NormalDist
+from time import perf_counter
+from typing import Any
+
+import numpy as np
+
+from .catalog import Catalog, get_catalog, load_catalog
+from .randomizer import CardChances, Distribution
+
+SIMULATION_CHUNK_SIZE = 1_000_000
+# Expected counts below this make the chi-square approximation unreliable;
+# such cells are pooled into one.
+MIN_EXPECTED = 5
+
+Combination = tuple[str, str, str, str]
+ATTRIBUTES = ("base_color", "background", "rarity", "nickname")
+
+
+def choose_indices(
+    distribution: Distribution[Any], n: int, rng: np.random.Generator
+) -> np.ndarray:
+    """Indices into `distribution.population` of `n` weighted draws, the
+    same rule as `Distribution.choose` applied to a whole column."""
+    cumulative = np.asarray(distribution.cum_weights, dtype=np.float64)
+    return np.searchsorted(cumulative, rng.random(n) * distribution.total, side="right")
+
+
+def combination_columns(chances: CardChances) -> list[list[str]]:
+    """Values of every attribute in ATTRIBUTES order; a drawn combination is
+    one index into each. Nicknames are listed player rarity by rarity."""
+    return [
+        chances.base_colors.population,
+        chances.backgrounds.population,
+        chances.rarities.population,
+        [nickname for players in chances.players.values() for nickname in players],
+    ]
+
+
+def simulate_chunk(catalog: Catalog, n: int, seed: int) -> np.ndarray:
+    """Draw `n` cards; return how often each combination came up, indexed
+    like `np.ravel_multi_index` over the `combination_columns` sizes."""
+    rng = np.random.default_rng(seed)
+    chances = CardChances(catalog)
+    players = [len(players) for players in chances.players.values()]
+    # Each rarity's nicknames follow those of the rarities before it.
+    offsets = np.cumsum([0, *players[:-1]])
+
+    player_rarities = choose_indices(chances.player_rarities, n, rng)
+    nicknames = offsets[player_rarities] + (
+        rng.random(n) * np.asarray(players)[player_rarities]
+    ).astype(np.int64)
+    columns = (
+        choose_indices(chances.base_colors, n, rng),
+        choose_indices(chances.backgrounds, n, rng),
+        choose_indices(chances.rarities, n, rng),
+        nicknames,
+    )
+
+    shape = tuple(len(values) for values in combination_columns(chances))
+    return np.bincount(np.ravel_multi_index(columns, shape), minlength=prod(shape))
+
+
+def simulate(
+    catalog: Catalog, draws: int, seed: int | None, workers: int
+) -> Counter[Combination]:
+    seed = random.randrange(2**32) if seed is None else seed
+    chunks = []
+    for start in range(0, draws, SIMULATION_CHUNK_SIZE):
+        size = min(SIMULATION_CHUNK_SIZE, draws - start)
+        # Chunk seeds depend on the chunk only, so --workers keeps results.
+        chunks.append((size, seed + start // SIMULATION_CHUNK_SIZE))
+
+    columns = combination_columns(CardChances(catalog))
+    totals = np.zeros(prod(len(values) for values in columns), dtype=np.int64)
+    if workers == 1:
+        for size, chunk_seed in chunks:
+            totals += simulate_chunk(catalog, size, chunk_seed)
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(simulate_chunk, catalog, size, chunk_seed)
+                for size, chunk_seed in chunks
+            ]
+            for future in futures:
+                totals += future.result()
+
+    # Only the few thousand combinations drawn are turned back into names.
+    drawn = np.flatnonzero(totals)
+    indices = np.unravel_index(drawn, tuple(len(values) for values in columns))
+    names = [
+        np.asarray(values)[index].tolist() for values, index in zip(columns, indices)
+    ]
+    return Counter(dict(zip(zip(*names), totals[drawn].tolist())))
+
+
+def exact_marginals(chances: CardChances) -> list[dict[str, float]]:
+    """Probability of every value of every attribute, in ATTRIBUTES order."""
+    nicknames: dict[str, float] = {}
+    for player_rarity, players in chances.players.items():
+        share = chances.player_rarities.probability(player_rarity) / len(players)
+        for nickname in players:
+            nicknames[nickname] = nicknames.get(nickname, 0.0) + share
+
+    return [
+        {option: distribution.probability(option) for option in distribution.population}
+        for distribution in (chances.base_colors, chances.backgrounds, chances.rarities)
+    ] + [nicknames]
+
+
+def product_of(marginals: list[dict[str, float]]) -> list[Combination]:
+    combinations: list[tuple[str, ...]] = [()]
+    for marginal in marginals:
+        combinations = [(*c, value) for c in combinations for value in marginal]
+    return combinations  # type: ignore
+
+
+@dataclass
+class ChiSquare:
+    statistic: float
+    dof: int
+    p_value: float
+    pooled: int
+
+
+def chi_square(observed: dict[Any, int], expected: dict[Any, float]) -> ChiSquare:
+    """Goodness of fit of `observed` counts to `expected` ones."""
+    statistic = 0.0
+    cells = 0
+    pooled = 0
+    pooled_observed = 0
+    pooled_expected = 0.0
+    for key, expected_count in expected.items():
+        observed_count = observed.get(key, 0)
+        if expected_count < MIN_EXPECTED:
+            pooled += 1
+            pooled_observed += observed_count
+            pooled_expected += expected_count
+            continue
+        statistic += (observed_count - expected_count) ** 2 / expected_count
+        cells += 1
+    if pooled_expected > 0:
+        statistic += (pooled_observed - pooled_expected) ** 2 / pooled_expected
+        cells += 1
+
+    dof = max(cells - 1, 1)
+    # Wilson-Hilferty: the cube root of chi2 / dof is close to normal.
+    z = ((statistic / dof) ** (1 / 3) - (1 - 2 / (9 * dof))) / sqrt(2 / (9 * dof))
+    return ChiSquare(statistic, dof, 1 - NormalDist().cdf(z), pooled)
+
+
+def print_attribute(
+    name: str, exact: dict[str, float], observed: Counter[str], draws: int
+):
+    print(f"\n{name}")
+    print(f"{'':<24}{'exact':>10}{'simulated':>11}")
+    for option, probability in sorted(exact.items(), key=lambda item: -item[1]):
+        print(f"{option:<24}{probability:>10.3%}{observed[option] / draws:>11.3%}")
+
+
+def print_deviations(
+    joint: dict[Combination, float],
+    counts: Counter[Combination],
+    draws: int,
+    limit: int,
+):
+    """Print the `limit` combinations whose simulated count is furthest from
+    the expected one, measured in binomial standard deviations.
+
+    Combinations expected fewer than MIN_EXPECTED times are skipped, as in
+    the chi-square test; a single draw of those is many deviations off.
+    """
+    deviations = {
+        combination: (counts[combination] - probability * draws)
+        / sqrt(draws * probability * (1 - probability))
+        for combination, probability in joint.items()
+        if probability * draws >= MIN_EXPECTED and probability < 1
+    }
+    worst = heapq.nlargest(limit, deviations, key=lambda c: abs(deviations[c]))
+    if not worst:
+        return
+
+    labels = {combination: "/".join(combination) for combination in worst}
+    width = max(len(label) for label in labels.values()) + 2
+    print("\nMost deviating combinations")
+    print(f"{'':<{width}}{'exact':>12}{'simulated':>12}{'sigma':>8}")
+    for combination in worst:
+        print(
+            f"{labels[combination]:<{width}}{joint[combination]:>12.3e}"
+            f"{counts[combination] / draws:>12.3e}{deviations[combination]:>+8.1f}"
+        )
+
+
+def print_test(name: str, result: ChiSquare):
+    pooled = f", {result.pooled} rare cells pooled" if result.pooled else ""
+    print(
+        f"{name:<24}chi2 {result.statistic:>12.1f}  dof {result.dof:>6}  "
+        f"p {result.p_value:.4f}{pooled}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m vannish_cards.simulator",
+        description="Check simulated drop rates against the index chances.",
+    )
+    parser.add_argument("--draws", type=int, default=10_000_000, help="cards to draw")
+    parser.add_argument("--seed", type=int, help="seed of the first chunk")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="processes"
+    )
+    parser.add_argument("--index", help="index.json to check instead of the current")
+    parser.add_argument(
+        "--alpha",
+        type=float,
+        default=0.001,
+        help="p-value below which a test fails (default 0.001)",
+    )
+    parser.add_argument(
+        "--combinations",
+        type=int,
+        default=10,
+        metavar="N",
+        help="list the N combinations furthest from their chance (default 10)",
+    )
+    args = parser.parse_args()
+
+    if args.index is None:
+        catalog = get_catalog()
+    else:
+        catalog = load_catalog(args.index)
+    chances = CardChances(catalog)
+
+    start = perf_counter()
+    counts = simulate(catalog, args.draws, args.seed, args.workers)
+    elapsed = perf_counter() - start
+    print(
+        f"{args.draws} cards drawn in {elapsed:.1f} s "
+        f"({args.draws / elapsed:,.0f} cards/s)"
+    )
+
+    marginals = exact_marginals(chances)
+    observed: list[Counter[str]] = [Counter() for _ in ATTRIBUTES]
+    for combination, count in counts.items():
+        for attribute, value in zip(observed, combination):
+            attribute[value] += count
+
+    # Card captions show these exact chances, rounded by format_chance.
+    for name, exact, attribute in zip(ATTRIBUTES, marginals, observed):
+        if name != "nickname":
+            print_attribute(name, exact, attribute, args.draws)
+
+    player_rarities = {
+        option: chances.player_rarities.probability(option)
+        for option in chances.player_rarities.population
+    }
+    player_rarity_counts: Counter[str] = Counter()
+    for player_rarity, players in chances.players.items():
+        for nickname in set(players):
+            player_rarity_counts[player_rarity] += observed[3][nickname]
+    print_attribute("player rarity", player_rarities, player_rarity_counts, args.draws)
+
+    # Attributes are drawn independently, so a combination's chance is the
+    # product of its values' chances.
+    joint = {
+        combination: prod(
+            marginal[value] for marginal, value in zip(marginals, combination)
+        )
+        for combination in product_of(marginals)
+    }
+    rarest = min(joint, key=joint.__getitem__)
+    print(
+        f"\n{len(joint)} combinations, {len(counts)} drawn; rarest "
+        f"{'/'.join(rarest)} at {joint[rarest]:.3g} per card"
+    )
+    print_deviations(joint, counts, args.draws, args.combinations)
+
+    print()
+    failed = False
+    tests = [
+        (
+            name,
+            chi_square(attribute, {k: v * args.draws for k, v in exact.items()}),
+        )
+        for name, exact, attribute in zip(ATTRIBUTES, marginals, observed)
+    ]
+    tests.append(
+        (
+            "combination",
+            chi_square(counts, {k: v * args.draws for k, v in joint.items()}),
+        )
+    )
+    for name, result in tests:
+        print_test(name, result)
+        failed = failed or result.p_value < args.alpha
+
+    if failed:
+        print(f"\nSimulated rates differ from the chances (p < {args.alpha})")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()